@@ -7,6 +7,15 @@ params.threads = ''
 params.data_directory = ''
 params.run_dwi = true // Toggle for running DWI processing, set via `--run_dwi false` to skip.
 params.cleanup = true
+params.reg_backend = 'ants' // Registration backend to MNI152/DWI: 'ants' (SyNRA) or 'voxelmorph'.
+params.vxm_model = '' // VoxelMorph pytorch model, required when --reg_backend voxelmorph.
+params.dwi_motion_model = 'rigid+syn' // Per-volume DWI motion model: rigid, affine, rigid+syn or affine+syn.
+params.atlas_cache = '' // Shared atlas cache directory (float32 atlas); disabled when empty.
+params.dwi_mem_limit = '' // Memory ceiling in GB for slab-wise DWI denoising; unbounded when empty.
+params.dwi_reference = '' // acq label of the reference DWI run; lowest non-zero shell, then most volumes, when empty.
+params.dwi_stream = false // Stream DWI volumes through motion, topup and bias correction in one process.
+params.texture_lut = '' // Label -> GM/WM table for the texture masks; SynthSeg labels when empty.
+params.texture_features = '' // Space-separated texture features (grad variance entropy glcm) written as one 4D image; none when empty.
 
 // 2) Add a CleanupWorkDir process at the bottom of your file
 process CleanupWorkDir {
@@ -27,14 +36,34 @@ process CleanupWorkDir {
 }
 
 
-process DwiDenoise {
+// ------------------------------------------------------------------
+// 0. DWI run discovery
+// ------------------------------------------------------------------
+process DwiIndex {
     conda "envs/micaflow.yml"
     publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy'
 
+    output:
+    path "dwi_manifest.tsv"
+
+    script:
+    """
+    python3 ${workflow.projectDir}/scripts/dwi_index.py \
+        --bids_dir ${file(params.data_directory)} \
+        --subject ${params.subject} \
+        --session ${params.session} \
+        --out dwi_manifest.tsv \
+        ${params.dwi_reference ? "--reference_acq ${params.dwi_reference}" : ''}
+    """
+}
+
+
+process DwiDenoise {
+    conda "envs/micaflow.yml"
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
+
     input:
-    tuple val(type), path(moving_path)
-    path bval
-    path bvec
+    tuple val(type), path(moving_path), path(bval), path(bvec)
 
     output:
     tuple val(type), path("denoised_moving.nii.gz")
@@ -44,40 +73,41 @@ process DwiDenoise {
     python3 ${workflow.projectDir}/scripts/dwi_denoise.py \
         --moving ${moving_path} \
         --bval ${bval} \
-        --bvec ${bvec}
+        --bvec ${bvec} \
+        --workers ${params.threads} \
+        ${params.dwi_mem_limit ? "--mem_limit ${params.dwi_mem_limit}" : ''}
     """
 }
 
 
 process DwiMotionCorrection {
     conda "envs/micaflow.yml"
-    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy'
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
     input:
-    tuple val(type), path(denoised_output)
-    path dwi_bval
-    path dwi_bvec
+    tuple val(type), path(denoised_output), path(dwi_bval), path(dwi_bvec)
 
     output:
     tuple val(type), path("moving_motion_corrected.nii.gz")
+    path "motion_parameters.tsv"
 
     script:
     """
     python3 ${workflow.projectDir}/scripts/dwi_motioncorrection.py \
         --denoised ${denoised_output} \
         --bval ${dwi_bval} \
-        --bvec ${dwi_bvec}
+        --bvec ${dwi_bvec} \
+        --workers ${params.threads} \
+        --threads ${params.threads} \
+        --transform ${params.dwi_motion_model}
     """
 }
 
 process DwiTopup {
     conda "envs/micaflow.yml"
-    publishDir "${params.out_dir}/${params.subject}/${params.session}/xfm", mode: 'copy'
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/xfm", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
 
     input:
-    tuple val(type), path(moving_path)
-    path b0_path
-    path b0_bval
-    path b0_bvec
+    tuple val(type), path(moving_path), path(b0_path), path(b0_bval), path(b0_bvec)
 
     output:
     tuple val(type), path("topup-warp-EstFieldMap.nii.gz"), path("corrected_image.nii.gz")
@@ -96,12 +126,10 @@ process DwiTopup {
 // ------------------------------------------------------------------
 process DwiApplyTopup {
     conda "envs/micaflow.yml"
-    publishDir "${params.out_dir}/${params.subject}/${params.session}/xfm", mode: 'copy'
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/xfm", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
 
     input:
-    tuple val(type), path(motion_corrected)
-    path warp_field
-    path input_affine // e.g. original DWI path, if needed
+    tuple val(type), path(motion_corrected), path(warp_field), path(input_affine) // affine from the original DWI
 
     output:
     tuple val(type), path("topup_corrected.nii.gz")
@@ -120,11 +148,10 @@ process DwiApplyTopup {
 // ------------------------------------------------------------------
 process DwiBiasCorrection {
     conda "envs/micaflow.yml"
-    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy'
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
 
     input:
-    tuple val(type), path(denoised_output)
-    path mask_path
+    tuple val(type), path(denoised_output), path(mask_path)
 
     output:
     tuple val(type), path("denoised_moving_corrected.nii.gz")
@@ -133,7 +160,31 @@ process DwiBiasCorrection {
     """
     python3 ${workflow.projectDir}/scripts/dwi_biascorrection.py \
         --image ${denoised_output} \
-        --mask ${mask_path}
+        --mask ${mask_path} \
+        --mode shared
+    """
+}
+// ------------------------------------------------------------------
+// 2-5. Motion, Topup and Bias Correction, one volume at a time
+// ------------------------------------------------------------------
+process DwiStreamCorrection {
+    conda "envs/micaflow.yml"
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
+
+    input:
+    tuple val(type), path(denoised_output), path(warp_field), path(mask_path)
+
+    output:
+    tuple val(type), path("denoised_moving_corrected.nii.gz")
+    path "motion_parameters.tsv"
+
+    script:
+    """
+    python3 ${workflow.projectDir}/scripts/dwi_stream.py \
+        --denoised ${denoised_output} \
+        --warp ${warp_field} \
+        --mask ${mask_path} \
+        --transform ${params.dwi_motion_model}
     """
 }
 process DwiRegistration {
@@ -158,22 +209,46 @@ process DwiRegistration {
         --affine ${params.subject}_${params.session}_from-DWI_to-${fixedType}_fwdaffine.mat \
         --rev_affine ${params.subject}_${params.session}_from-DWI_to-${fixedType}_bakaffine.mat \
         --warpfield ${params.subject}_${params.session}_from-DWI_to-${fixedType}_fwdfield.nii.gz \
-        --rev_warpfield ${params.subject}_${params.session}_from-DWI_to-${fixedType}_bakfield.nii.gz
+        --rev_warpfield ${params.subject}_${params.session}_from-DWI_to-${fixedType}_bakfield.nii.gz \
+        --backend ${params.reg_backend} ${params.vxm_model ? "--model ${params.vxm_model}" : ''}
+    """
+}
+
+process DwiAlignRun {
+    conda "envs/micaflow.yml"
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/dwi", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
+
+    input:
+    tuple val(type), path(bias_corrected), path(dwi_bval), path(dwi_bvec),
+          path(reference_dwi, stageAs: 'reference/*'), path(reference_bval, stageAs: 'reference/*'), path(reference_mask, stageAs: 'reference/*')
+
+    output:
+    tuple val(type), path("aligned_dwi.nii.gz"), path(dwi_bval), path("aligned.bvec")
+
+    script:
+    """
+    python3 ${workflow.projectDir}/scripts/dwi_align_runs.py \
+        --dwi ${bias_corrected} \
+        --bval ${dwi_bval} \
+        --bvec ${dwi_bvec} \
+        --reference ${reference_dwi} \
+        --reference_bval ${reference_bval} \
+        --reference_mask ${reference_mask}
     """
 }
 
+
 process DwiComputeFaMd {
     conda "envs/micaflow.yml"
     publishDir "${params.out_dir}/${params.subject}/${params.session}/metrics", mode: 'copy'
 
     input:
-    tuple val(type), path(bias_corrected)
+    // One entry per run, aligned to the reference run; runs and shells are concatenated only for the tensor fit
+    tuple val(types), path(bias_corrected, stageAs: 'run*/*'), path(dwi_bval, stageAs: 'run*/*'), path(dwi_bvec, stageAs: 'run*/*')
     path mask_path
-    path dwi_bval
-    path dwi_bvec
 
     output:
-    tuple val(type),
+    tuple val("dwi"),
           path("fa_map.nii.gz"),
           path("md_map.nii.gz")
 
@@ -183,7 +258,8 @@ process DwiComputeFaMd {
         --bias_corr ${bias_corrected} \
         --mask ${mask_path} \
         --bval ${dwi_bval} \
-        --bvec ${dwi_bvec}
+        --bvec ${dwi_bvec} \
+        --workers ${params.threads}
     """
 }
 
@@ -210,7 +286,8 @@ process DwiFaMdRegistration {
         --reg_affine ${affine_matrix_file} \
         --mapping ${nonlinear_forward_warp} \
         --out_fa fa_registered.nii.gz \
-        --out_md md_registered.nii.gz
+        --out_md md_registered.nii.gz \
+        ${params.atlas_cache ? "--atlas_cache ${params.atlas_cache}" : ''}
     """
 }
 
@@ -352,7 +429,29 @@ process Registration_MNI152 {
         --warp-file ${params.subject}_${params.session}_from-${type}_to-MNI152_fwdfield.nii.gz \
         --affine-file ${params.subject}_${params.session}_from-${type}_to-MNI152_fwdaffine.mat \
         --rev-warp-file ${params.subject}_${params.session}_from-${type}_to-MNI152_bakfield.nii.gz \
-        --rev-affine-file ${params.subject}_${params.session}_from-${type}_to-MNI152_bakaffine.mat 
+        --rev-affine-file ${params.subject}_${params.session}_from-${type}_to-MNI152_bakaffine.mat \
+        --backend ${params.reg_backend} ${params.vxm_model ? "--model ${params.vxm_model}" : ''} \
+        ${params.atlas_cache ? "--atlas-cache ${params.atlas_cache}" : ''}
+    """
+}
+
+process RegistrationQC {
+    conda "envs/micaflow.yml"
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/metrics", mode: 'copy'
+
+    input:
+    tuple val(type), path(registered), path(fwdfield), path(bakfield), path(fwdaffine), path(bakaffine)
+
+    output:
+    path "*_warpqc.json"
+
+    script:
+    def qc_name = fwdfield.name.replace('_fwdfield.nii.gz', '_warpqc.json')
+    """
+    python3 ${workflow.projectDir}/scripts/warp_quality.py \
+        --fwd ${fwdfield} \
+        --bak ${bakfield} \
+        --out ${qc_name}
     """
 }
 
@@ -403,30 +502,31 @@ process SkullStrip {
     publishDir "${params.out_dir}/${params.subject}/${params.session}/anat", mode: 'copy'
     
     input:
-    tuple val(type), path(image)
+    tuple val(types), path(images)
     
     output:
-    tuple val(type), path("${type}_hdbet.nii.gz") 
-    path "${type}_hdbet_bet.nii.gz"
+    path "*_hdbet.nii.gz", emit: brains
+    path "*_hdbet_bet.nii.gz", emit: masks
     
     script:
+    // All images go through one HD-BET model load
     """
     python3 ${workflow.projectDir}/scripts/hdbet.py \
-        --input ${image} \
-        --output ${type}_hdbet.nii.gz 
+        --input ${images.join(' ')} \
+        --output ${types.collect { "${it}_hdbet.nii.gz" }.join(' ')}
     """
 }
 
 
 process DWI_SkullStrip {
     conda "envs/micaflow.yml" 
-    publishDir "${params.out_dir}/${params.subject}/${params.session}/anat", mode: 'copy'
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/anat", mode: 'copy', saveAs: { fn -> "${type}_${fn}" }
     
     input:
-        path image
+    tuple val(type), path(image)
     
     output:
-    path "DWI_hdbet_bet.nii.gz"
+    tuple val(type), path("DWI_hdbet_bet.nii.gz")
     
     script:
     """
@@ -456,25 +556,53 @@ process CalculateMetrics {
     """
 }
 
+process WarpParcellationToMNI {
+    conda "envs/micaflow.yml" 
+    publishDir "${params.out_dir}/${params.subject}/${params.session}/xfm", mode: 'copy'
+    
+    input:
+    tuple val(type), path(parcellation), path(warp_field), path(affine), path(reference)
+    
+    output:
+    path "*_space-MNI152_parcellation.nii.gz"
+    
+    script:
+    """
+    python3 ${workflow.projectDir}/scripts/use_warp.py \
+        --moving ${parcellation} \
+        --reference ${reference} \
+        --affine ${affine} \
+        --warp ${warp_field} \
+        --interpolator genericLabel \
+        --out ${params.subject}_${params.session}_${type}_space-MNI152_parcellation.nii.gz
+    """
+}
+
 process RunTexture {
     conda "envs/micaflow.yml"
     publishDir "${params.out_dir}/${params.subject}/${params.session}/textures", mode: 'copy'
     
     input:
-    tuple val(type), path(image)
+    tuple val(types), path(images)
     path mask 
+    path labels
     
     output:
-    tuple val(type),
-        path("*_gradient_magnitude.nii"), 
-        path("*_relative_intensity.nii")
+    path("*_gradient_magnitude.nii")
+    path("*_relative_intensity.nii")
+    path("*_features.{nii.gz,txt}"), optional: true
 
     script:
+    // All modalities share one mask load and one GM/WM segmentation
     """
     python3 ${workflow.projectDir}/scripts/runtexture.py \
-        --input ${image} \
+        --input ${images.join(' ')} \
         --mask ${mask} \
-        --output ${params.subject}_${params.session}_${type}_textures_output
+        --labels ${labels} \
+        ${params.texture_lut ? "--label-lut ${params.texture_lut}" : ''} \
+        ${params.texture_features ? "--features ${params.texture_features}" : ''} \
+        --threads ${params.threads} \
+        --output ${types.collect { "${params.subject}_${params.session}_${it}_textures_output" }.join(' ')}
     """
 }
 
@@ -520,8 +648,19 @@ workflow {
 
 
 
-    // Execute SkullStrip process
-    (skullstrip_out, skull_mask) = SkullStrip(input_images)
+    // Execute SkullStrip process on all images at once, then pair each
+    // brain with its mask by type
+    SkullStrip(input_images.toList().map { items -> tuple(items.collect { it[0] }, items.collect { it[1] }) })
+    SkullStrip.out.brains.flatten()
+        .map { brain -> tuple(brain.name - '_hdbet.nii.gz', brain) }
+        .join(SkullStrip.out.masks.flatten().map { mask -> tuple(mask.name - '_hdbet_bet.nii.gz', mask) })
+        .multiMap { type, brain, mask ->
+            brain: tuple(type, brain)
+            mask: mask
+        }
+        .set { skullstrip }
+    skullstrip_out = skullstrip.brain
+    skull_mask = skullstrip.mask
 
     // Perform bias field correction
     n4_out = BiasFieldCorrection(skullstrip_out, skull_mask)
@@ -538,6 +677,9 @@ workflow {
     reg_out = Registration_T1w(seg_t1w, seg_flair)
     mni_reg_out = Registration_MNI152(seg_t1w, atlas_seg)
 
+    // Jacobian / inverse-consistency checks of the nonlinear fields
+    RegistrationQC(reg_out.mix(mni_reg_out))
+
     // Ensure separate N4 channels are ready
     n4_skullstrip_t1w = n4_out.filter { it[0] == 'T1w' }.map { tuple -> file(tuple[1]) }
     n4_skullstrip_flair = n4_out.filter { it[0] == 'FLAIR' }.map { tuple -> file(tuple[1]) }
@@ -591,8 +733,23 @@ workflow {
 
     texture_in = warped_flair.mix(warped_t1w)
 
-    // Call RunTexture (from your earlier definition) using texture_in.
-    texture_out = RunTexture(texture_in, atlas_mask)
+    // SynthSeg parcellation of the T1w in MNI space, warped with the same
+    // transforms as the images; its GM/WM labels replace Atropos in RunTexture
+    mni_parcellation = WarpParcellationToMNI(
+        seg_t1w.combine(mni_reg_out).map { combined ->
+            // [ type, parcellation, type, registeredImage, fwdfield, bakfield, fwdaffine, bakaffine ]
+            tuple('T1w', combined[1], combined[4], combined[6], atlas)
+        }
+    )
+
+    // Call RunTexture once for all modalities, T1w first so that it is the
+    // image segmented when no parcellation labels are used.
+    texture_out = RunTexture(
+        texture_in.toSortedList { a, b -> (a[0] == 'T1w' ? 0 : 1) <=> (b[0] == 'T1w' ? 0 : 1) }
+            .map { items -> tuple(items.collect { it[0] }, items.collect { it[1] }) },
+        atlas_mask,
+        mni_parcellation.first()
+    )
 
     warped_flair_metrics = warped_images.filter { it[0] == 'FLAIR' }
     warped_t1w_metrics = warped_images.filter { it[0] == 'T1w' }
@@ -610,85 +767,80 @@ workflow {
     // DWI pipeline (only run if params.run_dwi == true)
     // -----------------------------------------------------------
     if (params.run_dwi) {
-        // Input channels for DWI
-        Channel.fromPath("${params.data_directory}/${params.subject}/${params.session}/dwi/*.nii.gz")
-            .filter { it.name.contains("b700") }
-            .map { path -> tuple("b700", file(path)) }
-            .set { input_dwi }
-        Channel.fromPath("${params.data_directory}/${params.subject}/${params.session}/dwi/*.bvec")
-            .filter { it.name.contains("b700") }
-            .map { path -> file(path) }
-            .set { input_bvec }
-        Channel.fromPath("${params.data_directory}/${params.subject}/${params.session}/dwi/*.bval")
-            .filter { it.name.contains("b700") }
-            .map { path -> file(path) }
-            .set { input_bval }
-
-        Channel.fromPath("${params.data_directory}/${params.subject}/${params.session}/dwi/*.nii.gz")
-            .filter { it.name.contains("PA") }
-            .map { path -> file(path) }
-            .set { b0_img }
-        Channel.fromPath("${params.data_directory}/${params.subject}/${params.session}/dwi/*.bvec")
-            .filter { it.name.contains("PA") }
-            .map { path -> file(path) }
-            .set { b0_bvecs }
-        Channel.fromPath("${params.data_directory}/${params.subject}/${params.session}/dwi/*.bval")
-            .filter { it.name.contains("PA") }
-            .map { path -> file(path) }
-            .set { b0_bvals }
+        // One channel element per DWI run, described by the BIDS indexer
+        DwiIndex()
+            .splitCsv(header: true, sep: '\t')
+            .filter { row ->
+                if (row.reverse_dwi == 'n/a') {
+                    log.warn "Skipping DWI run ${row.run_id}: no reverse phase-encoded image"
+                }
+                row.reverse_dwi != 'n/a'
+            }
+            .set { dwi_runs }
+        input_dwi = dwi_runs.map { row -> tuple(row.run_id, file(row.dwi), file(row.bval), file(row.bvec)) }
+        gradients = input_dwi.map { run, dwi, bval, bvec -> tuple(run, bval, bvec) }
+        reference_run = dwi_runs.filter { it.reference == '1' }.map { tuple(it.run_id) }
 
 
         // 3) Topup
         topup_out = DwiTopup(
-            input_dwi, // or mc_out if desired
-            b0_img,
-            b0_bvals,
-            b0_bvecs
+            dwi_runs.map { row -> tuple(row.run_id, file(row.dwi), file(row.reverse_dwi), file(row.reverse_bval), file(row.reverse_bvec)) }
         )
+        topup_warp = topup_out.map { run, warp, corrected -> tuple(run, warp) }
+        topup_corrected = topup_out.map { run, warp, corrected -> tuple(run, corrected) }
 
-        DWI_mask = DWI_SkullStrip(topup_out.map{ it[2] })
+        DWI_mask = DWI_SkullStrip(topup_corrected)
 
 
         // 1) Denoise
-        denoised_out = DwiDenoise(
-            input_dwi,
-            input_bval,
-            input_bvec
-        )
-
-        // 2) Motion Correction
-        mc_out = DwiMotionCorrection(
-            denoised_out,
-            input_bval,
-            input_bvec
-        )
+        denoised_out = DwiDenoise(input_dwi)
+
+        if (params.dwi_stream) {
+            // 2-5) Motion, Topup and Bias Correction in one streaming pass
+            (bias_corr, mc_motion) = DwiStreamCorrection(
+                denoised_out.join(topup_warp).join(DWI_mask)
+            )
+        } else {
+            // 2) Motion Correction
+            (mc_out, mc_motion) = DwiMotionCorrection(
+                denoised_out.join(gradients)
+            )
+
+            // 4) Apply Topup
+            topup_applied = DwiApplyTopup(
+                mc_out.join(topup_warp).join(input_dwi.map { run, dwi, bval, bvec -> tuple(run, dwi) })
+            )
+
+            // 5) Bias Correction
+            bias_corr = DwiBiasCorrection(
+                topup_applied.join(DWI_mask)
+            )
+        }
 
-        // 4) Apply Topup
-        topup_applied = DwiApplyTopup(
-            mc_out,
-            topup_out.map{ it[1] },  // warp field
-            input_dwi.map{ it[1] },  // optional affine
-        )
+        // The reference run provides the DWI-space mask and registration target
+        reference_image = topup_corrected.join(reference_run).map { run, corrected -> corrected }
 
-        // 5) Bias Correction
-        bias_corr = DwiBiasCorrection(
-            topup_applied,
-            DWI_mask
-        )
-        
-        seg_DWI = SynthSeg_DWI(topup_out.map{ it[2] }, seg_flair)
+        seg_DWI = SynthSeg_DWI(reference_image, seg_flair)
 
         (lin_reg, nonlin_reg) = DwiRegistration(
             seg_DWI,
             seg_t1w
         )
 
-        // 8) Compute FA/MD
+        // 8) Rigidly align the other runs to the reference run, then compute
+        // FA/MD on all runs and shells together within the reference mask
+        run_data = bias_corr.join(gradients)
+        reference_data = run_data.join(reference_run)
+        other_runs = dwi_runs.filter { it.reference != '1' }.map { tuple(it.run_id) }
+        aligned_runs = DwiAlignRun(
+            run_data.join(other_runs)
+                .combine(reference_data.join(DWI_mask).map { run, dwi, bval, bvec, mask -> tuple(dwi, bval, mask) })
+        )
         fa_md = DwiComputeFaMd(
-            bias_corr,
-            topup_out.map{ it[2] }, // mask
-            input_bval,
-            input_bvec
+            reference_data.mix(aligned_runs)
+                .toSortedList { a, b -> a[0] <=> b[0] }
+                .map { runs -> tuple(runs.collect { it[0] }, runs.collect { it[1] }, runs.collect { it[2] }, runs.collect { it[3] }) },
+            DWI_mask.join(reference_run).map { run, mask -> mask }
         )
 
         // 9) FA/MD Registration
@@ -11,6 +11,12 @@ a scan (moving) to an atlas (fixed). To register a scan to the atlas and save th
 
 The source and target input images are expected to be affinely registered.
 
+To register a cohort to the same atlas, pass a text file with one moving image per line. The
+model and atlas stay resident and subjects are streamed through in mini-batches:
+
+    register.py --moving-list subjects.txt --fixed atlas.nii.gz --model model.pt
+        --moved-dir moved/ --warp-dir warps/ --batch-size 4 --threads 8
+
 If you use this code, please cite the following, and read function docs for further info/citations
     VoxelMorph: A Learning Framework for Deformable Medical Image Registration 
     G. Balakrishnan, A. Zhao, M. R. Sabuncu, J. Guttag, A.V. Dalca. 
@@ -37,6 +43,8 @@ the License.
 
 import os
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # third party
 import numpy as np
@@ -50,16 +58,30 @@ import voxelmorph as vxm   # nopep8
 
 # parse commandline args
 parser = argparse.ArgumentParser()
-parser.add_argument('--moving', required=True, help='moving image (source) filename')
+parser.add_argument('--moving', help='moving image (source) filename')
+parser.add_argument('--moving-list',
+                    help='text file with one moving image filename per line (batch mode)')
 parser.add_argument('--fixed', required=True, help='fixed image (target) filename')
-parser.add_argument('--moved', required=True, help='warped image output filename')
+parser.add_argument('--moved', help='warped image output filename')
+parser.add_argument('--moved-dir', help='output directory for warped images (batch mode)')
 parser.add_argument('--model', required=True, help='pytorch model for nonlinear registration')
 parser.add_argument('--warp', help='output warp deformation filename')
+parser.add_argument('--warp-dir', help='output directory for warp deformations (batch mode)')
+parser.add_argument('--batch-size', type=int, default=1,
+                    help='number of subjects per forward pass in batch mode (default: 1)')
+parser.add_argument('--threads', type=int, help='number of intra-op threads used on CPU')
 parser.add_argument('-g', '--gpu', help='GPU number(s) - if not supplied, CPU is used')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
 args = parser.parse_args()
 
+if bool(args.moving) == bool(args.moving_list):
+    parser.error('exactly one of --moving or --moving-list is required')
+if args.moving and not args.moved:
+    parser.error('--moved is required with --moving')
+if args.moving_list and not args.moved_dir:
+    parser.error('--moved-dir is required with --moving-list')
+
 # device handling
 if args.gpu and (args.gpu != '-1'):
     device = 'cuda'
@@ -68,9 +90,11 @@ else:
     device = 'cpu'
     os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
-# load moving and fixed images
+if args.threads:
+    torch.set_num_threads(args.threads)
+
+# load fixed image
 add_feat_axis = not args.multichannel
-moving = vxm.py.utils.load_volfile(args.moving, add_batch_axis=True, add_feat_axis=add_feat_axis)
 fixed, fixed_affine = vxm.py.utils.load_volfile(
     args.fixed, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=True)
 
@@ -79,19 +103,83 @@ model = vxm.networks.VxmDense.load(args.model, device)
 model.to(device)
 model.eval()
 
-# set up tensors and permute
-input_moving = torch.from_numpy(moving).to(device).float().permute(0, 4, 1, 2, 3)
+# the atlas tensor stays resident for the whole run
 input_fixed = torch.from_numpy(fixed).to(device).float().permute(0, 4, 1, 2, 3)
 
-# predict
-moved, warp = model(input_moving, input_fixed, registration=True)
+if args.moving:
+    # load moving image
+    moving = vxm.py.utils.load_volfile(args.moving, add_batch_axis=True, add_feat_axis=add_feat_axis)
 
-# save moved image
-if args.moved:
-    moved = moved.detach().cpu().numpy().squeeze()
-    vxm.py.utils.save_volfile(moved, args.moved, fixed_affine)
+    # set up tensors and permute
+    input_moving = torch.from_numpy(moving).to(device).float().permute(0, 4, 1, 2, 3)
 
-# save warp
-if args.warp:
-    warp = warp.detach().cpu().numpy().squeeze()
-    vxm.py.utils.save_volfile(warp, args.warp, fixed_affine)
+    # predict
+    with torch.inference_mode():
+        moved, warp = model(input_moving, input_fixed, registration=True)
+
+    # save moved image
+    if args.moved:
+        moved = moved.detach().cpu().numpy().squeeze()
+        vxm.py.utils.save_volfile(moved, args.moved, fixed_affine)
+
+    # save warp
+    if args.warp:
+        warp = warp.detach().cpu().numpy().squeeze()
+        vxm.py.utils.save_volfile(warp, args.warp, fixed_affine)
+else:
+    with open(args.moving_list) as f:
+        moving_files = [line.strip() for line in f if line.strip()]
+
+    def output_name(path, directory):
+        name = os.path.basename(path)
+        for ext in ('.nii.gz', '.nii', '.npz', '.npy', '.mgz'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+                break
+        return os.path.join(directory, name + '.nii.gz')
+
+    # outputs are named after the moving basename, so refuse anything that would overwrite
+    names = [output_name(f, '') for f in moving_files]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        parser.error('moving images with the same output name: %s' % ', '.join(duplicates))
+    if args.warp_dir and os.path.realpath(args.warp_dir) == os.path.realpath(args.moved_dir):
+        parser.error('--moved-dir and --warp-dir must be different directories')
+
+    os.makedirs(args.moved_dir, exist_ok=True)
+    if args.warp_dir:
+        os.makedirs(args.warp_dir, exist_ok=True)
+
+    # compression and disk writes overlap with the next forward pass; at most
+    # 2 * batch_size writes are pending, and a failed write is re-raised here
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending = deque()
+
+    def write(volume, filename):
+        while len(pending) >= 2 * args.batch_size:
+            pending.popleft().result()
+        pending.append(writer.submit(vxm.py.utils.save_volfile, volume, filename, fixed_affine))
+
+    for start in range(0, len(moving_files), args.batch_size):
+        batch_files = moving_files[start:start + args.batch_size]
+        moving = np.concatenate([
+            vxm.py.utils.load_volfile(f, add_batch_axis=True, add_feat_axis=add_feat_axis)
+            for f in batch_files
+        ])
+        input_moving = torch.from_numpy(moving).to(device).float().permute(0, 4, 1, 2, 3)
+        batch_fixed = input_fixed.expand(len(batch_files), *input_fixed.shape[1:])
+
+        with torch.inference_mode():
+            moved, warp = model(input_moving, batch_fixed, registration=True)
+        moved = moved.cpu().numpy()
+        warp = warp.cpu().numpy()
+
+        for i, moving_file in enumerate(batch_files):
+            write(moved[i].squeeze(), output_name(moving_file, args.moved_dir))
+            if args.warp_dir:
+                write(warp[i].squeeze(), output_name(moving_file, args.warp_dir))
+        print('registered %d/%d' % (start + len(batch_files), len(moving_files)))
+
+    while pending:
+        pending.popleft().result()
+    writer.shutdown()
@@ -14,6 +14,9 @@ import os
 import subprocess
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from dwi_denoise import patch2self_slabs
+
 def bias_field_correction(image, output):
     """
     Apply N4 bias field correction to the input image using the provided mask.
@@ -52,13 +55,9 @@ def process_dwi(input_dwi, bval_file, bvec_file, output_dir):
     print("B-values:", np.unique(bvals))
 
 
-    from dipy.data import get_fnames
-    from dipy.denoise.patch2self import patch2self
-    
-    denoised_dwi = patch2self(
+    denoised_dwi = patch2self_slabs(
     dwi_img,
     bvals,
-    model="ols",
     shift_intensity=True,
     clip_negative_vals=False,
     b0_threshold=50,
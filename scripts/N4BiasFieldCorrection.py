@@ -2,10 +2,70 @@ import ants
 import argparse
 
 
-def bias_field_correction(image, output, mask):
+def load_mask(mask, img):
+    """
+    Binary brain mask on the grid of img, resampled when its physical space
+    (shape, spacing, origin or direction) differs. Without a mask path, one
+    is estimated from img with ants.get_mask.
+    """
+    if mask is None:
+        return ants.get_mask(img)
+    mask_img = ants.image_read(mask)
+    if not ants.image_physical_space_consistency(mask_img, img):
+        mask_img = ants.resample_image_to_target(mask_img, img, interp_type="nearestNeighbor")
+    return ants.threshold_image(mask_img, 0, 0, 0, 1)
+
+
+def apply_bias_field(img, field):
+    """
+    Divide img by a multiplicative bias field, resampled to the grid of img
+    when its physical space differs. The field must already be aligned with
+    img in world coordinates; it is not registered.
+    """
+    if not ants.image_physical_space_consistency(field, img):
+        field = ants.resample_image_to_target(field, img, interp_type="linear")
+    return img / field
+
+
+def bias_field_correction(image, output, mask, shrink_factor=4, spline_distance=None,
+                          iterations=(50, 50, 50, 50), tol=1e-7, bias_field=None, apply_field=None):
+    """
+    N4 bias field correction within a brain mask.
+
+    N4 estimates the field on the image shrunk by shrink_factor and
+    reconstructs it at full resolution; the image is then divided by that
+    field, so estimation runs once even when the field is also written.
+
+    Parameters:
+    - image, output: input and corrected image paths.
+    - mask: brain mask path (e.g. HD-BET), or None to estimate one.
+    - shrink_factor: int, N4 shrink factor.
+    - spline_distance: float, B-spline control point spacing in mm, or None
+      for the ANTsPy default mesh.
+    - iterations: maximum iterations per resolution level.
+    - tol: convergence tolerance.
+    - bias_field: optional path to write the estimated field to.
+    - apply_field: optional path of a field to apply instead of estimating one.
+    """
     img = ants.image_read(image)
-    mask_img = ants.get_mask(img)
-    corrected_img = ants.n4_bias_field_correction(img, mask_img)
+    if img.pixeltype != "float":
+        img = img.clone("float")
+
+    if apply_field is not None:
+        field = ants.image_read(apply_field)
+    else:
+        field = ants.n4_bias_field_correction(
+            img,
+            mask=load_mask(mask, img),
+            shrink_factor=shrink_factor,
+            convergence={"iters": list(iterations), "tol": tol},
+            spline_param=spline_distance,
+            return_bias_field=True,
+        )
+        if bias_field is not None:
+            ants.image_write(field, bias_field)
+
+    corrected_img = apply_bias_field(img, field)
     ants.image_write(corrected_img, output)
 
 
@@ -15,6 +75,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output", "-o", required=True, help="Output corrected image file"
     )
-    parser.add_argument("-m", "--mask", help="Save binary brain mask to path.")
+    parser.add_argument("-m", "--mask", help="Brain mask restricting the field estimation (estimated when omitted)")
+    parser.add_argument("--shrink_factor", type=int, default=4,
+                        help="Shrink factor of the image the field is estimated on (default: 4)")
+    parser.add_argument("--spline_distance", type=float, default=None,
+                        help="B-spline control point spacing in mm (default: ANTsPy mesh)")
+    parser.add_argument("--iterations", type=int, nargs="+", default=[50, 50, 50, 50],
+                        help="Maximum iterations per resolution level (default: 50 50 50 50)")
+    parser.add_argument("--tol", type=float, default=1e-7,
+                        help="Convergence tolerance (default: 1e-7)")
+    parser.add_argument("--bias_field", default=None,
+                        help="Also write the estimated multiplicative bias field to this path")
+    parser.add_argument("--apply_field", default=None,
+                        help="Apply this bias field instead of estimating one. It must already be in the "
+                             "physical space of --input (e.g. from a co-registered modality); it is "
+                             "resampled to the input grid but not registered")
     args = parser.parse_args()
-    bias_field_correction(args.input, args.output, args.mask)
+    bias_field_correction(args.input, args.output, args.mask, args.shrink_factor, args.spline_distance,
+                          args.iterations, args.tol, args.bias_field, args.apply_field)
@@ -16,7 +16,10 @@ License.
 
 # python imports
 import os
+import json
+import multiprocessing
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from scipy.stats import wilcoxon
 from scipy.ndimage.morphology import distance_transform_edt
 
@@ -25,34 +28,75 @@ from ext.lab2im import utils
 from ext.lab2im import edit_volumes
 
 
-def fast_dice(x, y, labels):
-    """Fast implementation of Dice scores.
+def label_confusion_matrix(x, y, labels, chunk_size=None):
+    """Confusion matrix of two integer label maps restricted to a list of labels.
+    Label values are compacted with a lookup table to 0..n_labels-1 (all other values are grouped in a last index
+    n_labels), and the matrix is obtained with a single np.bincount of lut[x] * (n_labels + 1) + lut[y].
     :param x: input label map
     :param y: input label map of the same size as x
-    :param labels: numpy array of labels to evaluate on
-    :return: numpy array with Dice scores in the same order as labels.
+    :param labels: 1d numpy array of unique labels
+    :param chunk_size: (optional) number of voxels processed at once, to bound memory on large volumes. Default is None,
+    where all voxels are processed at once.
+    :return: numpy array of shape (n_labels + 1, n_labels + 1), where entry (i, j) counts the voxels with labels[i] in x
+    and labels[j] in y.
     """
 
     assert x.shape == y.shape, 'both inputs should have same size, had {} and {}'.format(x.shape, y.shape)
+    x = np.asarray(x).ravel()
+    y = np.asarray(y).ravel()
+    if not np.issubdtype(x.dtype, np.integer):
+        x = np.rint(x).astype('int64')
+    if not np.issubdtype(y.dtype, np.integer):
+        y = np.rint(y).astype('int64')
+    labels = np.asarray(labels).astype('int64')
+    n_labels = len(labels)
+
+    # lookup table from label values to compact indices
+    lowest = int(min(x.min(), y.min(), labels.min()))
+    highest = int(max(x.max(), y.max(), labels.max()))
+    lut = np.full(highest - lowest + 1, n_labels, dtype='int64')
+    lut[labels - lowest] = np.arange(n_labels)
+
+    chunk_size = len(x) if chunk_size is None else max(chunk_size, 1)
+    confusion = np.zeros((n_labels + 1) ** 2, dtype='int64')
+    for start in range(0, len(x), chunk_size):
+        idx = lut[x[start:start + chunk_size] - lowest] * (n_labels + 1) + lut[y[start:start + chunk_size] - lowest]
+        confusion += np.bincount(idx, minlength=(n_labels + 1) ** 2)
+
+    return confusion.reshape((n_labels + 1, n_labels + 1))
+
+
+def label_overlap(x, y, labels, chunk_size=None):
+    """Dice scores, Jaccard indices and volumes (in voxels) of several labels, from a single confusion matrix.
+    :param x: input label map
+    :param y: input label map of the same size as x
+    :param labels: numpy array of labels to evaluate on
+    :param chunk_size: (optional) see label_confusion_matrix.
+    :return: dice, jaccard, volumes_x, volumes_y: numpy arrays in the same order as labels. Scores are 0 for labels
+    absent from both label maps.
+    """
 
-    if len(labels) > 1:
-        # sort labels
-        labels_sorted = np.sort(labels)
-
-        # build bins for histograms
-        label_edges = np.sort(np.concatenate([labels_sorted - 0.1, labels_sorted + 0.1]))
-        label_edges = np.insert(label_edges, [0, len(label_edges)], [labels_sorted[0] - 0.1, labels_sorted[-1] + 0.1])
+    unique_labels, order = np.unique(np.asarray(labels), return_inverse=True)
+    confusion = label_confusion_matrix(x, y, unique_labels, chunk_size)
+    overlap = np.diag(confusion)[:-1].astype('float')
+    volumes_x = np.sum(confusion, axis=1)[:-1]
+    volumes_y = np.sum(confusion, axis=0)[:-1]
 
-        # compute Dice and re-arrange scores in initial order
-        hst = np.histogram2d(x.flatten(), y.flatten(), bins=label_edges)[0]
-        idx = np.arange(start=1, stop=2 * len(labels_sorted), step=2)
-        dice_score = 2 * np.diag(hst)[idx] / (np.sum(hst, 0)[idx] + np.sum(hst, 1)[idx] + 1e-5)
-        dice_score = dice_score[np.searchsorted(labels_sorted, labels)]
+    total = volumes_x + volumes_y
+    dice_score = np.where(total > 0, 2 * overlap / np.maximum(total, 1), 0)
+    jaccard = np.where(total > 0, overlap / np.maximum(total - overlap, 1), 0)
+    return dice_score[order], jaccard[order], volumes_x[order], volumes_y[order]
 
-    else:
-        dice_score = dice(x == labels[0], y == labels[0])
 
-    return dice_score
+def fast_dice(x, y, labels, chunk_size=None):
+    """Fast implementation of Dice scores.
+    :param x: input label map
+    :param y: input label map of the same size as x
+    :param labels: numpy array of labels to evaluate on
+    :param chunk_size: (optional) number of voxels processed at once (see label_confusion_matrix).
+    :return: numpy array with Dice scores in the same order as labels.
+    """
+    return label_overlap(x, y, utils.reformat_to_list(labels), chunk_size)[0]
 
 
 def dice(x, y):
@@ -150,6 +194,96 @@ def surface_distances(x, y, hausdorff_percentile=None, return_coordinate_max_dis
         return max_dist, mean_dist
 
 
+def label_boundaries(x):
+    """Boundary voxels of all the labels of a label map in a single pass.
+    A voxel is on the boundary of its label if one of its face neighbours (inside the volume) has another value, i.e.
+    the distance_transform_edt(x == label) == 1 test of surface_distances applied to the whole volume rather than to a
+    tight crop (which misses boundary voxels lying on the crop border).
+    :param x: input label map
+    :return: labels, coordinates: labels is a sorted 1d array of the labels with a boundary, and coordinates a list with
+    the (n_voxels, n_dims) boundary coordinates of each of these labels."""
+
+    edge = np.zeros(x.shape, dtype='bool')
+    for axis in range(len(x.shape)):
+        lower = [slice(None)] * len(x.shape)
+        upper = [slice(None)] * len(x.shape)
+        lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+        different = x[tuple(lower)] != x[tuple(upper)]
+        edge[tuple(lower)] |= different
+        edge[tuple(upper)] |= different
+
+    # group boundary voxels by label
+    coordinates = np.stack(np.nonzero(edge), axis=1)
+    edge_labels = x[edge]
+    order = np.argsort(edge_labels, kind='stable')
+    labels, starts = np.unique(edge_labels[order], return_index=True)
+    coordinates = np.split(coordinates[order], starts[1:])
+    return labels, coordinates
+
+
+def boundary_distances(x_edge, y_edge, hausdorff_percentile):
+    """Hausdorff and mean distances between two sets of boundary voxel coordinates, computed with two distance maps on
+    the bounding box of both boundaries."""
+
+    both = np.concatenate([x_edge, y_edge])
+    lower = np.min(both, axis=0)
+    shape = np.max(both, axis=0) - lower + 1
+    x_edge = x_edge - lower
+    y_edge = y_edge - lower
+
+    x_mask = np.ones(shape, dtype='bool')
+    x_mask[tuple(x_edge.T)] = False
+    y_mask = np.ones(shape, dtype='bool')
+    y_mask[tuple(y_edge.T)] = False
+    x_dists_to_y = distance_transform_edt(y_mask)[tuple(x_edge.T)]
+    y_dists_to_x = distance_transform_edt(x_mask)[tuple(y_edge.T)]
+
+    dists = np.concatenate([x_dists_to_y, y_dists_to_x])
+    max_dist = [np.max(dists) if hd_percentile == 100 else np.percentile(dists, hd_percentile)
+                for hd_percentile in hausdorff_percentile]
+    mean_dist = (np.mean(x_dists_to_y) + np.mean(y_dists_to_x)) / 2
+    return max_dist, mean_dist
+
+
+def surface_distances_labels(x, y, labels, hausdorff_percentile=None, n_threads=1):
+    """Computes surface distances (as in surface_distances) for several labels of two label maps at once.
+    All boundaries are extracted in one pass per label map, and distance maps are only computed on the bounding box of
+    the boundaries of each label, in parallel threads.
+    :param x: input label map
+    :param y: input label map of the same size as x
+    :param labels: numpy array of labels to evaluate on
+    :param hausdorff_percentile: (optional) percentile or list of percentiles (from 0 to 100) for which to compute the
+    Hausdorff distance. Default is 100.
+    :param n_threads: (optional) number of threads over which labels are distributed. Default is 1.
+    :return: max_dists, mean_dists
+    max_dists: numpy array of shape (n_labels, n_percentiles) with HD computed for the given percentiles.
+    mean_dists: numpy array of shape (n_labels,) with average surface distances.
+    Labels missing from x or y get the maximum volume shape for all distances."""
+
+    assert x.shape == y.shape, 'both inputs should have same size, had {} and {}'.format(x.shape, y.shape)
+    hausdorff_percentile = utils.reformat_to_list(100 if hausdorff_percentile is None else hausdorff_percentile)
+    labels = np.array(utils.reformat_to_list(labels))
+
+    x_labels, x_edges = label_boundaries(x)
+    y_labels, y_edges = label_boundaries(y)
+    x_edges = dict(zip(x_labels.tolist(), x_edges))
+    y_edges = dict(zip(y_labels.tolist(), y_edges))
+
+    max_dists = np.full((len(labels), len(hausdorff_percentile)), max(x.shape), dtype='float')
+    mean_dists = np.full(len(labels), max(x.shape), dtype='float')
+    present = [i for i, label in enumerate(labels.tolist()) if (label in x_edges) & (label in y_edges)]
+
+    def compute(i):
+        return boundary_distances(x_edges[labels[i]], y_edges[labels[i]], hausdorff_percentile)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        for i, (max_dist, mean_dist) in zip(present, executor.map(compute, present)):
+            max_dists[i] = max_dist
+            mean_dists[i] = mean_dist
+
+    return max_dists, mean_dists
+
+
 def compute_non_parametric_paired_test(dice_ref, dice_compare, eval_indices=None, alternative='two-sided'):
     """Compute non-parametric paired t-tests between two sets of Dice scores.
     :param dice_ref: numpy array with Dice scores, rows represent structures, and columns represent subjects.
@@ -210,6 +344,96 @@ def cohens_d(volumes_x, volumes_y):
     return cohensd
 
 
+def evaluate_subject(path_gt,
+                     path_seg,
+                     path_mask,
+                     label_list,
+                     compute_distances,
+                     compute_score_whole_structure=False,
+                     crop_margin_around_gt=10,
+                     list_incorrect_labels=None,
+                     list_correct_labels=None,
+                     use_nearest_label=False,
+                     n_threads=1):
+    """Computes the scores of evaluation for a single pair of gt and segmentation label maps.
+    See evaluation for the description of the parameters.
+    :return: a dictionary (row of the results store) with the paths of the evaluated label maps, and the Dice scores,
+    max distances (HD, HD99, HD95) and mean distances as lists, with one more entry for the whole structure if
+    compute_score_whole_structure is True. Distances are None if compute_distances is False.
+    Whole-structure distances use the boundaries of surface_distances_labels like the labels do, so they are not
+    comparable with results computed with surface_distances on the cropped structure, which missed the boundary voxels
+    lying on the crop border (e.g. a HD of 14.53 instead of 18.71).
+    """
+
+    # load gt labels and segmentation
+    max_label = np.max(label_list) + 1
+    gt_labels = utils.load_volume(path_gt, dtype='int', aff_ref=np.eye(4))
+    seg = utils.load_volume(path_seg, dtype='int', aff_ref=np.eye(4))
+    if path_mask is not None:
+        mask = utils.load_volume(path_mask, dtype='bool', aff_ref=np.eye(4))
+        gt_labels[mask] = max_label
+        seg[mask] = max_label
+
+    # crop images
+    if crop_margin_around_gt > 0:
+        gt_labels, cropping = edit_volumes.crop_volume_around_region(gt_labels, margin=crop_margin_around_gt)
+        seg = edit_volumes.crop_volume_with_idx(seg, cropping)
+
+    if list_incorrect_labels is not None:
+        seg = edit_volumes.correct_label_map(seg, list_incorrect_labels, list_correct_labels, use_nearest_label)
+
+    # compute Dice scores
+    dice_coefs = fast_dice(gt_labels, seg, label_list).tolist()
+
+    # compute Dice scores for whole structures
+    if compute_score_whole_structure:
+        temp_gt = (gt_labels > 0) * 1
+        temp_seg = (seg > 0) * 1
+        dice_coefs.append(dice(temp_gt, temp_seg))
+    else:
+        temp_gt = temp_seg = None
+
+    # compute average and Hausdorff distances
+    max_dists = mean_dists = None
+    if compute_distances:
+
+        # compute max/mean surface distances for all labels at once
+        max_dists, mean_dists = surface_distances_labels(gt_labels, seg, label_list, [100, 99, 95], n_threads)
+        max_dists, mean_dists = max_dists.tolist(), mean_dists.tolist()
+
+        # compute max/mean distances for whole structure
+        if compute_score_whole_structure:
+            tmp_max_dists, tmp_mean_dists = surface_distances_labels(temp_gt, temp_seg, [1], [100, 99, 95], n_threads)
+            max_dists.append(tmp_max_dists[0].tolist())
+            mean_dists.append(float(tmp_mean_dists[0]))
+
+    return {'gt': path_gt, 'seg': path_seg, 'dice': [float(d) for d in dice_coefs],
+            'max_dists': max_dists, 'mean_dists': mean_dists}
+
+
+def read_results_store(path_results):
+    """Reads the rows of an append-only results store, indexed by the path of the evaluated segmentation.
+    Incomplete lines (e.g. of an interrupted evaluation) are ignored."""
+    rows = dict()
+    if (path_results is not None) and os.path.isfile(path_results):
+        with open(path_results) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                rows[row['seg']] = row
+    return rows
+
+
+def append_results_row(path_results, row):
+    """Appends a row to the results store, and flushes it to disk."""
+    if path_results is not None:
+        with open(path_results, 'a') as f:
+            f.write(json.dumps(row) + '\n')
+            f.flush()
+
+
 def evaluation(gt_dir,
                seg_dir,
                label_list,
@@ -225,7 +449,10 @@ def evaluation(gt_dir,
                list_correct_labels=None,
                use_nearest_label=False,
                recompute=True,
-               verbose=True):
+               verbose=True,
+               n_threads=1,
+               path_results=None,
+               n_workers=1):
     """This function computes Dice scores, as well as surface distances, between two sets of labels maps in gt_dir
     (ground truth) and seg_dir (typically predictions). Label maps in both folders are matched by sorting order.
     The resulting scores are saved at the specified locations.
@@ -254,8 +481,16 @@ def evaluation(gt_dir,
     :param list_correct_labels: (optional) list of values to correct the labels specified in list_incorrect_labels.
     Correct values must have the same order as their corresponding value in list_incorrect_labels.
     :param use_nearest_label: (optional) whether to correct the incorrect label values with the nearest labels.
-    :param recompute: (optional) whether to recompute the already existing results. Default is True.
+    :param recompute: (optional) whether to recompute the already existing results. Default is True. If False,
+    subjects already in the results store (see path_results) with the same evaluation settings (labels, whole-structure
+    scores, cropping margin and label corrections) are not evaluated again, so that an interrupted or extended
+    evaluation only computes the missing subjects.
     :param verbose: (optional) whether to print out info about the remaining number of cases.
+    :param n_threads: (optional) number of threads used to compute the surface distances of the labels. Default is 1.
+    :param path_results: (optional) path of the append-only results store, where one row is written per subject as soon
+    as it is evaluated. Default is None, where it is placed next to path_dice (<path_dice>_subjects.jsonl), or not used
+    if path_dice is None.
+    :param n_workers: (optional) number of processes over which subjects are distributed. Default is 1.
     """
 
     # check whether to recompute
@@ -265,8 +500,16 @@ def evaluation(gt_dir,
     compute_hausdorff_95 = not os.path.isfile(path_hausdorff_95) if (path_hausdorff_95 is not None) else False
     compute_mean_dist = not os.path.isfile(path_mean_distance) if (path_mean_distance is not None) else False
     compute_hd = [compute_hausdorff, compute_hausdorff_99, compute_hausdorff_95]
+    # distances are computed whenever they are written, so that existing files are not overwritten with zeros
+    compute_distances = any(path is not None for path in [path_hausdorff, path_hausdorff_99, path_hausdorff_95,
+                                                          path_mean_distance])
+
+    # results store, which also lets a partial evaluation be resumed
+    if (path_results is None) & (path_dice is not None):
+        path_results = os.path.splitext(path_dice)[0] + '_subjects.jsonl'
+    resume = (not recompute) & (path_results is not None) and os.path.isfile(path_results)
 
-    if compute_dice | any(compute_hd) | compute_mean_dist | recompute:
+    if compute_dice | any(compute_hd) | compute_mean_dist | recompute | resume:
 
         # get list label maps to compare
         path_gt_labels = utils.list_images_in_folder(gt_dir)
@@ -284,73 +527,76 @@ def evaluation(gt_dir,
         # load labels list
         label_list, _ = utils.get_list_labels(label_list=label_list, labels_dir=gt_dir)
         n_labels = len(label_list)
-        max_label = np.max(label_list) + 1
-
-        # initialise result matrices
-        if compute_score_whole_structure:
-            max_dists = np.zeros((n_labels + 1, len(path_segs), 3))
-            mean_dists = np.zeros((n_labels + 1, len(path_segs)))
-            dice_coefs = np.zeros((n_labels + 1, len(path_segs)))
+        n_rows = n_labels + 1 if compute_score_whole_structure else n_labels
+
+        # find the subjects that are not in the results store yet
+        if path_results is not None:
+            utils.mkdir(os.path.dirname(path_results))
+            if recompute & os.path.isfile(path_results):
+                os.remove(path_results)
+        # rows are only reused if they were computed with the same settings (as read back from json)
+        settings = dict(label_list=label_list,
+                        compute_score_whole_structure=compute_score_whole_structure,
+                        crop_margin_around_gt=crop_margin_around_gt,
+                        list_incorrect_labels=utils.load_array_if_path(list_incorrect_labels),
+                        list_correct_labels=utils.load_array_if_path(list_correct_labels),
+                        use_nearest_label=use_nearest_label)
+        settings = json.loads(json.dumps(settings, default=lambda x: x.tolist()))
+        rows = read_results_store(path_results)
+        rows = {path_seg: row for path_seg, row in rows.items()
+                if (row.get('settings') == settings) & (len(row['dice']) == n_rows) &
+                ((row['mean_dists'] is not None) | (not compute_distances))}
+        todo = [idx for idx, path_seg in enumerate(path_segs) if path_seg not in rows]
+        if verbose & (len(todo) < len(path_segs)):
+            print('found {} evaluated subjects in {}'.format(len(path_segs) - len(todo), path_results))
+
+        # evaluate the missing subjects, and store each row as soon as it is computed
+        kwargs = dict(label_list=label_list,
+                      compute_distances=compute_distances,
+                      compute_score_whole_structure=compute_score_whole_structure,
+                      crop_margin_around_gt=crop_margin_around_gt,
+                      list_incorrect_labels=list_incorrect_labels,
+                      list_correct_labels=list_correct_labels,
+                      use_nearest_label=use_nearest_label,
+                      n_threads=n_threads)
+        loop_info = utils.LoopInfo(len(todo), 10, 'evaluating', print_time=True)
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(evaluate_subject, path_gt_labels[idx], path_segs[idx], path_masks[idx],
+                                           **kwargs) for idx in todo]
+                # store every completed row before raising the first error, so that a resumed evaluation keeps them
+                error = None
+                for n_done, future in enumerate(as_completed(futures)):
+                    if verbose:
+                        loop_info.update(n_done)
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        error = e if error is None else error
+                        continue
+                    row['settings'] = settings
+                    append_results_row(path_results, row)
+                    rows[row['seg']] = row
+                if error is not None:
+                    raise error
         else:
-            max_dists = np.zeros((n_labels, len(path_segs), 3))
-            mean_dists = np.zeros((n_labels, len(path_segs)))
-            dice_coefs = np.zeros((n_labels, len(path_segs)))
-
-        # loop over segmentations
-        loop_info = utils.LoopInfo(len(path_segs), 10, 'evaluating', print_time=True)
-        for idx, (path_gt, path_seg, path_mask) in enumerate(zip(path_gt_labels, path_segs, path_masks)):
-            if verbose:
-                loop_info.update(idx)
-
-            # load gt labels and segmentation
-            gt_labels = utils.load_volume(path_gt, dtype='int', aff_ref=np.eye(4))
-            seg = utils.load_volume(path_seg, dtype='int', aff_ref=np.eye(4))
-            if path_mask is not None:
-                mask = utils.load_volume(path_mask, dtype='bool', aff_ref=np.eye(4))
-                gt_labels[mask] = max_label
-                seg[mask] = max_label
-
-            # crop images
-            if crop_margin_around_gt > 0:
-                gt_labels, cropping = edit_volumes.crop_volume_around_region(gt_labels, margin=crop_margin_around_gt)
-                seg = edit_volumes.crop_volume_with_idx(seg, cropping)
-
-            if list_incorrect_labels is not None:
-                seg = edit_volumes.correct_label_map(seg, list_incorrect_labels, list_correct_labels, use_nearest_label)
-
-            # compute Dice scores
-            dice_coefs[:n_labels, idx] = fast_dice(gt_labels, seg, label_list)
-
-            # compute Dice scores for whole structures
-            if compute_score_whole_structure:
-                temp_gt = (gt_labels > 0) * 1
-                temp_seg = (seg > 0) * 1
-                dice_coefs[-1, idx] = dice(temp_gt, temp_seg)
-            else:
-                temp_gt = temp_seg = None
-
-            # compute average and Hausdorff distances
-            if any(compute_hd) | compute_mean_dist:
-
-                # compute unique label values
-                unique_gt_labels = np.unique(gt_labels)
-                unique_seg_labels = np.unique(seg)
-
-                # compute max/mean surface distances for all labels
-                for index, label in enumerate(label_list):
-                    if (label in unique_gt_labels) & (label in unique_seg_labels):
-                        mask_gt = np.where(gt_labels == label, True, False)
-                        mask_seg = np.where(seg == label, True, False)
-                        tmp_max_dists, mean_dists[index, idx] = surface_distances(mask_gt, mask_seg, [100, 99, 95])
-                        max_dists[index, idx, :] = np.array(tmp_max_dists)
-                    else:
-                        mean_dists[index, idx] = max(gt_labels.shape)
-                        max_dists[index, idx, :] = np.array([max(gt_labels.shape)] * 3)
-
-                # compute max/mean distances for whole structure
-                if compute_score_whole_structure:
-                    tmp_max_dists, mean_dists[-1, idx] = surface_distances(temp_gt, temp_seg, [100, 99, 95])
-                    max_dists[-1, idx, :] = np.array(tmp_max_dists)
+            for n_done, idx in enumerate(todo):
+                if verbose:
+                    loop_info.update(n_done)
+                row = evaluate_subject(path_gt_labels[idx], path_segs[idx], path_masks[idx], **kwargs)
+                row['settings'] = settings
+                append_results_row(path_results, row)
+                rows[row['seg']] = row
+
+        # gather result matrices in the order of the subjects
+        max_dists = np.zeros((n_rows, len(path_segs), 3))
+        mean_dists = np.zeros((n_rows, len(path_segs)))
+        dice_coefs = np.zeros((n_rows, len(path_segs)))
+        for idx, path_seg in enumerate(path_segs):
+            dice_coefs[:, idx] = rows[path_seg]['dice']
+            if compute_distances:
+                max_dists[:, idx, :] = rows[path_seg]['max_dists']
+                mean_dists[:, idx] = rows[path_seg]['mean_dists']
 
         # write results
         if path_dice is not None:
@@ -0,0 +1,123 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+import nibabel as nib
+import numpy as np
+
+AtlasAssets = namedtuple("AtlasAssets", ["data", "affine", "path"])
+
+
+def atlas_key(atlas_path):
+    """
+    Cache key of an atlas from its resolved path, size and modification time.
+    Nextflow stages inputs as symlinks, which resolve to the same source file;
+    the atlas is never read to compute the key.
+    """
+    real_path = os.path.realpath(atlas_path)
+    stat = os.stat(real_path)
+    ident = json.dumps([real_path, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(ident.encode()).hexdigest()[:16]
+
+
+def build_atlas_cache(atlas_path, cache_dir):
+    """
+    Persist a float32 copy of the atlas and its affine under cache_dir.
+
+    The entry is assembled in a temporary directory and renamed into place,
+    so concurrent subjects never see a partial cache.
+
+    Parameters:
+    - atlas_path: str, path to the atlas image.
+    - cache_dir: str, shared cache directory.
+
+    Returns:
+    - entry_dir: str, the directory holding the cached artefacts.
+    """
+    entry_dir = os.path.join(cache_dir, atlas_key(atlas_path))
+    if os.path.exists(os.path.join(entry_dir, "meta.json")):
+        return entry_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+    try:
+        img = nib.load(atlas_path)
+        data = np.asarray(img.dataobj, dtype=np.float32)
+        np.save(os.path.join(tmp_dir, "data.npy"), data)
+
+        meta = {
+            "source": os.path.realpath(atlas_path),
+            "shape": list(data.shape),
+            "affine": img.affine.tolist(),
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another subject finished building the same entry first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return entry_dir
+
+
+def load_atlas(atlas_path, cache_dir):
+    """
+    Load the cached float32 atlas memory-mapped, building it on first use.
+
+    Returns:
+    - AtlasAssets with the read-only memmapped data, the atlas affine and the
+      cache entry directory.
+    """
+    entry_dir = build_atlas_cache(atlas_path, cache_dir)
+    with open(os.path.join(entry_dir, "meta.json")) as f:
+        meta = json.load(f)
+    data = np.load(os.path.join(entry_dir, "data.npy"), mmap_mode="r")
+    return AtlasAssets(data=data, affine=np.asarray(meta["affine"]), path=entry_dir)
+
+
+def atlas_nifti(assets):
+    """Wrap the cached float32 atlas in a nibabel image without copying it."""
+    return nib.Nifti1Image(assets.data, assets.affine)
+
+
+def atlas_ants(assets):
+    """
+    Build an ANTsImage from the cached atlas. ANTs stores geometry in LPS, so
+    the RAS affine is converted to origin/spacing/direction.
+    """
+    import ants
+
+    affine = assets.affine
+    spacing = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    lps = np.diag([-1.0, -1.0, 1.0])
+    direction = lps @ (affine[:3, :3] / spacing)
+    origin = lps @ affine[:3, 3]
+    # from_numpy copies into ITK memory; the memmap is passed as is
+    return ants.from_numpy(
+        assets.data,
+        origin=tuple(origin),
+        spacing=tuple(spacing),
+        direction=direction,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the atlas cache (float32 copy of the atlas)."
+    )
+    parser.add_argument("--atlas", type=str, required=True,
+                        help="Path to the atlas image (NIfTI file).")
+    parser.add_argument("--cache-dir", type=str, required=True,
+                        help="Shared cache directory.")
+    args = parser.parse_args()
+
+    entry_dir = build_atlas_cache(args.atlas, args.cache_dir)
+    print("Atlas cache ready in:", entry_dir)
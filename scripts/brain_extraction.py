@@ -0,0 +1,96 @@
+import nibabel as nib
+import numpy as np
+
+# HD-BET predictors already loaded in this process, keyed by (device, use_tta).
+_predictors = {}
+
+
+def default_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_predictor(device=None, use_tta=True):
+    """
+    Load the HD-BET nnU-Net predictor once per process.
+
+    Parameters:
+    - device: str, "cuda", "cpu" or "mps" (default: cuda when available).
+    - use_tta: bool, test-time mirroring as in the hd-bet CLI default.
+
+    Returns:
+    - predictor: nnUNetPredictor with the HD-BET weights.
+    """
+    device = device or default_device()
+    key = (device, use_tta)
+    if key not in _predictors:
+        import torch
+        from HD_BET.checkpoint_download import maybe_download_parameters
+        from HD_BET.hd_bet_prediction import get_hdbet_predictor
+
+        maybe_download_parameters()
+        _predictors[key] = get_hdbet_predictor(use_tta=use_tta, device=torch.device(device))
+    return _predictors[key]
+
+
+def predict_mask(data, zooms, predictor):
+    """
+    HD-BET brain mask of one 3D array.
+
+    nnU-Net works on SimpleITK-ordered arrays (z, y, x) with spacing in the
+    same order, which is what the hd-bet CLI feeds it after reading the file.
+
+    Parameters:
+    - data: 3D numpy array in NIfTI index order (x, y, z).
+    - zooms: voxel sizes (x, y, z).
+    - predictor: see get_predictor.
+
+    Returns:
+    - mask: uint8 numpy array (x, y, z), 1 inside the brain.
+    """
+    image = np.asarray(data, dtype=np.float32).transpose(2, 1, 0)[None]
+    properties = {"spacing": [float(z) for z in zooms[:3]][::-1]}
+    seg = predictor.predict_single_npy_array(image, properties, None, None, False)
+    return (np.asarray(seg).transpose(2, 1, 0) > 0).astype(np.uint8)
+
+
+def extract_brains(images, device=None, use_tta=True):
+    """
+    Brain-extract a batch of in-memory 3D images with a single model load.
+
+    Parameters:
+    - images: list of (data, affine) tuples.
+    - device, use_tta: see get_predictor.
+
+    Returns:
+    - results: list of (mask, brain) tuples; brain is data with everything
+      outside the mask set to 0, in the dtype of data.
+    """
+    predictor = get_predictor(device, use_tta)
+    results = []
+    for data, affine in images:
+        zooms = np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0))
+        mask = predict_mask(data, zooms, predictor)
+        brain = np.array(data, copy=True)
+        brain[mask == 0] = 0
+        results.append((mask, brain))
+    return results
+
+
+def extract_brain_files(inputs, outputs, device=None, use_tta=True):
+    """
+    Brain-extract NIfTI files, writing <output> and the mask <output>_bet.nii.gz
+    like `hd-bet --save_bet_mask`.
+
+    Returns:
+    - mask_paths: list of written mask paths.
+    """
+    imgs = [nib.load(path) for path in inputs]
+    results = extract_brains([(np.asanyarray(img.dataobj), img.affine) for img in imgs], device, use_tta)
+    mask_paths = []
+    for img, out_path, (mask, brain) in zip(imgs, outputs, results):
+        mask_path = out_path[:-7] + "_bet.nii.gz"
+        nib.save(nib.Nifti1Image(brain, img.affine, img.header), out_path)
+        nib.save(nib.Nifti1Image(mask, img.affine), mask_path)
+        mask_paths.append(mask_path)
+    return mask_paths
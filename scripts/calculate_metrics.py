@@ -1,45 +1,79 @@
 import sys
 import csv
-import os
-from nipype.algorithms.metrics import Overlap
+import numpy as np
 import nibabel as nib
 
 
-def apply_threshold(image_path, threshold=0.5):
-    img = nib.load(image_path)
-    data = img.get_fdata()
-    data[data < threshold] = 0
-    # Write to a new file to avoid in-place modifications that may cause issues
-    new_image_path = image_path.replace(".nii", "_thr.nii")
-    nib.save(nib.Nifti1Image(data, img.affine), new_image_path)
-    return new_image_path
+def load_labels(image_path, threshold=0.5):
+    """
+    Integer label array of an image: values below threshold, negative or NaN
+    become 0 and the rest are truncated to integers.
+    """
+    data = np.asanyarray(nib.load(image_path).dataobj).astype(np.float64)
+    data[~(data >= threshold)] = 0
+    return data.astype(np.int64)
 
 
-def main(image, reference, output_file, threshold=0.5, mask_path=None):
+def overlap_metrics(image, reference, mask=None):
+    """
+    Per-ROI overlap of two label arrays from three label histograms.
+
+    tp is the np.bincount of the labels where both arrays agree, and the
+    label volumes are the bincounts of each array, so fp and fn follow
+    without a confusion matrix and memory stays O(max label). The ROIs are
+    the positive labels of `image` (as in nipype's Overlap).
+
+    Parameters:
+    - image, reference: non-negative integer label arrays of the same shape.
+    - mask: optional boolean array; voxels outside it are treated as background.
 
-    # Apply threshold and use the new file paths
-    image_thr = apply_threshold(image, threshold)
-    reference_thr = apply_threshold(reference, threshold)
+    Returns:
+    - metrics: dict of 1D arrays over the ROIs: label, tp, fp, fn, jaccard,
+      dice and volume_similarity.
+    """
+    image = np.asarray(image).ravel()
+    reference = np.asarray(reference).ravel()
+    if mask is not None:
+        inside = np.asarray(mask, dtype=bool).ravel()
+        image = np.where(inside, image, 0)
+        reference = np.where(inside, reference, 0)
 
-    overlap = Overlap()
-    overlap.inputs.volume1 = image_thr
-    overlap.inputs.volume2 = reference_thr
+    n = int(max(image.max(), reference.max(), 0)) + 1
+    tp = np.bincount(image[image == reference], minlength=n)
+    vol_img = np.bincount(image, minlength=n)
+    vol_ref = np.bincount(reference, minlength=n)
+    rois = np.flatnonzero(vol_img)
+    rois = rois[rois > 0]
 
-    if mask_path:
-        # Optionally process mask similarly if thresholding is required
-        mask_thr = apply_threshold(mask_path, threshold)
-        overlap.inputs.mask_volume = mask_thr
+    tp = tp[rois].astype(np.float64)
+    fp = vol_img[rois] - tp
+    fn = vol_ref[rois] - tp
+    union = tp + fp + fn
+    return {
+        "label": rois,
+        "tp": tp,
+        "fp": fp,
+        "fn": fn,
+        "jaccard": tp / union,
+        "dice": 2 * tp / (union + tp),
+        "volume_similarity": 1 - np.abs(fp - fn) / (union + tp),
+    }
+
+
+def main(image, reference, output_file, threshold=0.5, mask_path=None):
 
-    res = overlap.run()
+    # Thresholded labels are kept in memory; no _thr copies are written
+    mask = np.asanyarray(nib.load(mask_path).dataobj) >= threshold if mask_path else None
+    metrics = overlap_metrics(load_labels(image, threshold), load_labels(reference, threshold), mask)
 
     # Print the number of ROIs
-    num_rois = len(res.outputs.roi_ji)
+    num_rois = len(metrics["jaccard"])
     print("Number of ROIs:", num_rois)
 
     with open(output_file, "w", newline="") as file:
         csvwriter = csv.writer(file)
         csvwriter.writerow(["ROI", "Jaccard Index"])
-        for i, ji in enumerate(res.outputs.roi_ji):
+        for i, ji in enumerate(metrics["jaccard"]):
             csvwriter.writerow([i + 1, ji])
 
 
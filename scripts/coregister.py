@@ -2,6 +2,8 @@ import ants
 import argparse
 import shutil
 
+BACKENDS = ("ants", "voxelmorph")
+
 
 def ants_linear_nonlinear_registration(
     fixed_file,
@@ -11,17 +13,36 @@ def ants_linear_nonlinear_registration(
     affine_file=None,
     rev_warp_file=None,
     rev_affine_file=None,
+    backend="ants",
+    model_file=None,
+    atlas_cache=None,
 ):
     """
     Perform linear (rigid + affine) and nonlinear registration using ANTsPy (SyN transform).
     Optionally save the warp field and affine transform to user-specified files.
+
+    With backend="voxelmorph" the nonlinear step is a single forward pass of the
+    VoxelMorph model in ``model_file`` after an ANTs affine pre-alignment.
+
+    When ``atlas_cache`` is given, the fixed image (the atlas) is loaded from the
+    shared atlas cache instead of being re-read and decompressed for every subject.
     """
     # Load images
-    fixed = ants.image_read(fixed_file)
+    if atlas_cache:
+        from atlas_cache import atlas_ants, load_atlas
+
+        fixed = atlas_ants(load_atlas(fixed_file, atlas_cache))
+    else:
+        fixed = ants.image_read(fixed_file)
     moving = ants.image_read(moving_file)
 
-    # 'SyN' transform includes both linear and nonlinear registration.
-    transforms = ants.registration(fixed=fixed, moving=moving, type_of_transform="SyNRA")
+    if backend == "voxelmorph":
+        from vxm_registration import voxelmorph_registration
+
+        transforms = voxelmorph_registration(fixed, moving, model_file)
+    else:
+        # 'SyN' transform includes both linear and nonlinear registration.
+        transforms = ants.registration(fixed=fixed, moving=moving, type_of_transform="SyNRA")
 
     # The result of the registration is a dictionary containing, among other keys:
     # 'warpedmovout' and 'fwdtransforms' (list of transform paths generated).
@@ -33,6 +54,8 @@ def ants_linear_nonlinear_registration(
 
     # If specified, save the transform files
     # Typically, transforms["fwdtransforms"][0] is the warp field, and [1] is the affine.
+    # The inverse list is reversed: transforms["invtransforms"][0] is the affine
+    # (inverted when applied) and [1] is the inverse warp field.
     if warp_file:
         shutil.copyfile(transforms["fwdtransforms"][0], warp_file)
         print(f"Saved warp field as {warp_file}")
@@ -40,10 +63,10 @@ def ants_linear_nonlinear_registration(
         shutil.copyfile(transforms["fwdtransforms"][1], affine_file)
         print(f"Saved affine transform as {affine_file}")
     if rev_warp_file:
-        shutil.copyfile(transforms["invtransforms"][0], rev_warp_file)
+        shutil.copyfile(transforms["invtransforms"][1], rev_warp_file)
         print(f"Saved reverse warp field as {rev_warp_file}")
     if rev_affine_file:
-        shutil.copyfile(transforms["invtransforms"][1], rev_affine_file)
+        shutil.copyfile(transforms["invtransforms"][0], rev_affine_file)
         print(f"Saved reverse affine transform as {rev_affine_file}")
 
 
@@ -78,7 +101,25 @@ def main():
         default=None,
         help="Optional path to save the reverse affine transform.",
     )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="ants",
+        help="Nonlinear registration backend: ANTs SyNRA or a VoxelMorph model.",
+    )
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="Path to the VoxelMorph pytorch model (required with --backend voxelmorph).",
+    )
+    parser.add_argument(
+        "--atlas-cache",
+        default=None,
+        help="Optional shared atlas cache directory used to load the fixed image.",
+    )
     args = parser.parse_args()
+    if args.backend == "voxelmorph" and not args.model:
+        parser.error("--model is required with --backend voxelmorph")
 
     ants_linear_nonlinear_registration(
         args.fixed_file,
@@ -88,6 +129,9 @@ def main():
         affine_file=args.affine_file,
         rev_warp_file=args.rev_warp_file,
         rev_affine_file=args.rev_affine_file,
+        backend=args.backend,
+        model_file=args.model,
+        atlas_cache=args.atlas_cache,
     )
     print(f"Registration complete. Saved as {args.out_file}")
 
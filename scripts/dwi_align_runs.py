@@ -0,0 +1,117 @@
+import argparse
+
+import ants
+import nibabel as nib
+import numpy as np
+from dipy.io.gradients import read_bvals_bvecs
+
+from dwi_motioncorrection import motion_parameters
+
+# ANTs works in LPS world coordinates, nibabel in RAS.
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+
+
+def mean_b0(dwi, bvals, b0_threshold=50):
+    """
+    Mean of the b0 volumes of a 4D ANTsImage as a 3D ANTsImage with the
+    spatial geometry of the run (the first volume when there is no b0).
+    """
+    volumes = ants.ndimage_to_list(dwi)
+    b0s = [volumes[i].numpy() for i in np.flatnonzero(bvals <= b0_threshold)] or [volumes[0].numpy()]
+    return volumes[0].new_image_like(np.mean(b0s, axis=0)), volumes
+
+
+def voxel_rotation(affine):
+    """
+    Rotation from FSL bvec coordinates to RAS world coordinates: the
+    normalised affine columns, with FSL's x flip for a positive determinant.
+    """
+    rotation = affine[:3, :3] / np.linalg.norm(affine[:3, :3], axis=0)
+    if np.linalg.det(affine[:3, :3]) > 0:
+        rotation = rotation @ np.diag([-1.0, 1.0, 1.0])
+    return rotation
+
+
+def rotate_bvecs(bvecs, transform_path, moving_affine, fixed_affine):
+    """
+    Express the gradient directions of the moving run in the voxel frame of
+    the reference run, through the rotation of the rigid transform.
+
+    Parameters:
+    - bvecs: (n, 3) array of the moving run.
+    - transform_path: ANTs linear transform mapping reference to run points.
+    - moving_affine, fixed_affine: nibabel affines of the run and the reference.
+
+    Returns:
+    - bvecs: (n, 3) rotated gradient directions.
+    """
+    params = np.asarray(ants.read_transform(transform_path).parameters, dtype=np.float64)
+    u, _, vt = np.linalg.svd(params[:9].reshape(3, 3))
+    rotation = LPS_TO_RAS @ (u @ vt) @ LPS_TO_RAS
+    # run world -> reference world is the inverse (transpose) of the transform rotation
+    to_fixed = voxel_rotation(fixed_affine).T @ rotation.T @ voxel_rotation(moving_affine)
+    return bvecs @ to_fixed.T
+
+
+def align_run(dwi_path, bval_path, bvec_path, ref_path, ref_bval_path, ref_mask_path,
+              out_dwi="aligned_dwi.nii.gz", out_bvec="aligned.bvec", b0_threshold=50):
+    """
+    Rigidly register one DWI run to the reference run and resample all its
+    volumes onto the reference grid, so that runs can be concatenated for a
+    single tensor fit.
+
+    The mean b0 of the run is registered to the mean b0 of the reference
+    within the reference brain mask with a full Rigid registration (runs can
+    be further apart than the volumes of one run, for which the motion
+    correction uses QuickRigid); each volume is then resampled with that
+    transform and the bvecs are rotated with it. The bvals are unchanged.
+
+    Returns:
+    - out_dwi, out_bvec: paths of the aligned image and bvecs.
+    """
+    bvals, bvecs = read_bvals_bvecs(bval_path, bvec_path)
+    ref_bvals, _ = read_bvals_bvecs(ref_bval_path, None)
+    ref_b0, _ = mean_b0(ants.image_read(ref_path), ref_bvals, b0_threshold)
+    run_b0, volumes = mean_b0(ants.image_read(dwi_path), bvals, b0_threshold)
+    mask = ants.threshold_image(ants.image_read(ref_mask_path), 0, 0, 0, 1)
+
+    reg = ants.registration(fixed=ref_b0, moving=run_b0, type_of_transform="Rigid", mask=mask)
+    transform = reg["fwdtransforms"][0]
+    print("Run to reference motion (mm, rad):", np.round(motion_parameters(transform), 4).tolist())
+
+    aligned = np.stack([ants.apply_transforms(ref_b0, volume, [transform], interpolator="linear").numpy()
+                        for volume in volumes], axis=-1).astype(np.float32)
+    ref_affine = nib.load(ref_path).affine
+    nib.save(nib.Nifti1Image(aligned, ref_affine), out_dwi)
+    rotated = rotate_bvecs(bvecs, transform, nib.load(dwi_path).affine, ref_affine)
+    np.savetxt(out_bvec, rotated.T, fmt="%.6f")
+    return out_dwi, out_bvec
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rigidly align a preprocessed DWI run to the reference run of the session."
+    )
+    parser.add_argument("--dwi", type=str, required=True,
+                        help="Path to the preprocessed DWI run (NIfTI file).")
+    parser.add_argument("--bval", type=str, required=True,
+                        help="Path to the bvals file of the run.")
+    parser.add_argument("--bvec", type=str, required=True,
+                        help="Path to the bvecs file of the run.")
+    parser.add_argument("--reference", type=str, required=True,
+                        help="Path to the preprocessed reference run (NIfTI file).")
+    parser.add_argument("--reference_bval", type=str, required=True,
+                        help="Path to the bvals file of the reference run.")
+    parser.add_argument("--reference_mask", type=str, required=True,
+                        help="Brain mask of the reference run restricting the registration metric.")
+    parser.add_argument("--out_dwi", type=str, default="aligned_dwi.nii.gz",
+                        help="Output path of the run resampled onto the reference grid.")
+    parser.add_argument("--out_bvec", type=str, default="aligned.bvec",
+                        help="Output path of the rotated bvecs.")
+    parser.add_argument("--b0_threshold", type=float, default=50,
+                        help="b-values at or below this are treated as b0 (default: 50).")
+    args = parser.parse_args()
+
+    out_dwi, out_bvec = align_run(args.dwi, args.bval, args.bvec, args.reference, args.reference_bval,
+                                  args.reference_mask, args.out_dwi, args.out_bvec, args.b0_threshold)
+    print("Aligned DWI saved as:", out_dwi)
+    print("Rotated bvecs saved as:", out_bvec)
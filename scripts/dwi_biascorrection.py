@@ -2,14 +2,66 @@ import ants
 import numpy as np
 import argparse
 
-def run_bias_field_correction(image_path, mask_path):
+def estimate_shared_bias_field(img, img_data, mask_ants, reference="b0", shrink_factor=4):
+    """
+    Estimate one N4 bias field for the whole 4D image.
+
+    The receive-coil bias is the same for every volume, so it is estimated
+    once on a reference volume within the mask.
+
+    Parameters:
+    - img: 4D ANTsImage, used for the geometry.
+    - img_data: 4D numpy array of the image.
+    - mask_ants: ANTsImage of the brain mask.
+    - reference: "b0" (first volume) or "mean" (mean over all volumes).
+    - shrink_factor: int, N4 shrink factor.
+
+    Returns:
+    - field: 3D float32 numpy array of the multiplicative bias field.
+    """
+    if reference == "mean":
+        ref = img_data.mean(axis=-1, dtype=np.float32)
+    else:
+        ref = img_data[..., 0]
+    return bias_field_of_volume(ref, img.spacing[:3], img.origin[:3], img.direction[:3, :3],
+                                mask_ants, shrink_factor)
+
+
+def bias_field_of_volume(ref, spacing, origin, direction, mask_ants, shrink_factor=4):
+    """
+    N4 bias field of a single 3D volume.
+
+    Parameters:
+    - ref: 3D numpy array.
+    - spacing, origin, direction: 3D geometry of the volume.
+    - mask_ants: ANTsImage of the brain mask.
+    - shrink_factor: int, N4 shrink factor.
+
+    Returns:
+    - field: 3D float32 numpy array of the multiplicative bias field.
+    """
+    ref_ants = ants.from_numpy(ref, spacing=spacing, origin=origin, direction=direction)
+    field = ants.n4_bias_field_correction(ref_ants, mask=mask_ants,
+                                          shrink_factor=shrink_factor,
+                                          return_bias_field=True)
+    return field.numpy().astype(np.float32)
+
+
+def run_bias_field_correction(image_path, mask_path, mode="per-volume", reference="b0", shrink_factor=4):
     """
     Apply N4 bias field correction to each 3D volume (along the last axis).
-    
+
+    With mode="shared" the field is estimated once (see
+    estimate_shared_bias_field) and all volumes are divided by it in one
+    vectorised operation instead of running N4 per volume.
+
     Parameters:
     - image_path: path to the input image.
     - mask_path: path to the mask image.
-    
+    - mode: "per-volume" or "shared".
+    - reference: reference volume for the shared field, "b0" or "mean".
+    - shrink_factor: int, N4 shrink factor.
+
     Returns:
     - out_path: path to the bias-corrected image.
     """
@@ -17,16 +69,23 @@ def run_bias_field_correction(image_path, mask_path):
     mask_ants = ants.image_read(mask_path)
     img_data = img.numpy()
 
-    corrected_vols = []
-    for i in range(img_data.shape[-1]):
-        vol = img_data[..., i]
-        vol_ants = ants.from_numpy(vol,
-                                   spacing=img.spacing[:3],
-                                   origin=img.origin[:3],
-                                   direction=img.direction[:3, :3])
-        corrected_vol_ants = ants.n4_bias_field_correction(vol_ants, mask=mask_ants)
-        corrected_vols.append(corrected_vol_ants.numpy())
-    corrected_array = np.stack(corrected_vols, axis=-1)
+    if mode == "shared":
+        field = estimate_shared_bias_field(img, img_data, mask_ants, reference, shrink_factor)
+        corrected_array = np.divide(img_data, field[..., None], dtype=np.float32,
+                                    out=np.zeros(img_data.shape, dtype=np.float32),
+                                    where=field[..., None] > 0)
+    else:
+        corrected_vols = []
+        for i in range(img_data.shape[-1]):
+            vol = img_data[..., i]
+            vol_ants = ants.from_numpy(vol,
+                                       spacing=img.spacing[:3],
+                                       origin=img.origin[:3],
+                                       direction=img.direction[:3, :3])
+            corrected_vol_ants = ants.n4_bias_field_correction(vol_ants, mask=mask_ants,
+                                                               shrink_factor=shrink_factor)
+            corrected_vols.append(corrected_vol_ants.numpy())
+        corrected_array = np.stack(corrected_vols, axis=-1)
     corrected_img = ants.from_numpy(corrected_array,
                                     spacing=img.spacing,
                                     origin=img.origin,
@@ -43,7 +102,13 @@ if __name__ == "__main__":
                         help="Path to the input image (NIfTI file).")
     parser.add_argument("--mask", type=str, required=True,
                         help="Path to the mask image (NIfTI file).")
-    
+    parser.add_argument("--mode", type=str, choices=["per-volume", "shared"], default="per-volume",
+                        help="Run N4 on every volume, or estimate one field and apply it to all volumes.")
+    parser.add_argument("--reference", type=str, choices=["b0", "mean"], default="b0",
+                        help="Volume the shared field is estimated on (default: b0).")
+    parser.add_argument("--shrink_factor", type=int, default=4,
+                        help="N4 shrink factor (default: 4).")
+
     args = parser.parse_args()
-    out_path = run_bias_field_correction(args.image, args.mask)
-    print("Bias-corrected image saved as:", out_path)
\ No newline at end of file
+    out_path = run_bias_field_correction(args.image, args.mask, args.mode, args.reference, args.shrink_factor)
+    print("Bias-corrected image saved as:", out_path)
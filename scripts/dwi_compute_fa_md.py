@@ -1,38 +1,150 @@
 import argparse
-from dipy.reconst.dti import TensorModel
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from dipy.reconst.dti import (TensorModel, axial_diffusivity, fractional_anisotropy,
+                              mean_diffusivity, radial_diffusivity)
 from dipy.core.gradients import gradient_table
+from dipy.io.gradients import read_bvals_bvecs
 import nibabel as nib
 
+# Per-process tensor model of the pool workers, set once by _init_worker.
+_worker = {}
+
+
+def _init_worker(bvals, bvecs):
+    _worker["model"] = TensorModel(gradient_table(bvals, bvecs=bvecs))
+
+
+def _fit_chunk(signals):
+    fit = _worker["model"].fit(signals)
+    return fit.evals.astype(np.float32), fit.evecs.astype(np.float32)
+
+
+def fit_tensor_masked(data, mask, bvals, bvecs, chunk_size=20000, workers=1):
+    """
+    Fit the diffusion tensor on in-mask voxels only.
+
+    In-mask signals are gathered into a compact (n_vox, n_dirs) float32
+    matrix and fitted in chunks, across a process pool when workers > 1.
+    Scalar maps and the principal eigenvector are scattered back into volumes;
+    voxels outside the mask are 0.
+
+    Parameters:
+    - data: 4D numpy array (nx, ny, nz, n_dirs).
+    - mask: 3D array, non-zero inside the brain.
+    - bvals, bvecs: numpy arrays of the gradient table.
+    - chunk_size: int, voxels per fit.
+    - workers: int, number of worker processes.
+
+    Returns:
+    - maps: dict of float32 volumes 'fa', 'md', 'ad', 'rd' and 'v1' (nx, ny, nz, 3).
+    """
+    inside = np.asarray(mask) > 0
+    signals = np.asarray(data[inside], dtype=np.float32)
+    chunks = [signals[i:i + chunk_size] for i in range(0, len(signals), chunk_size)]
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(bvals, bvecs)) as pool:
+            results = list(pool.map(_fit_chunk, chunks))
+    else:
+        _init_worker(bvals, bvecs)
+        results = [_fit_chunk(chunk) for chunk in chunks]
+
+    if results:
+        evals = np.concatenate([r[0] for r in results])
+        evecs = np.concatenate([r[1] for r in results])
+    else:
+        evals = np.zeros((0, 3), dtype=np.float32)
+        evecs = np.zeros((0, 3, 3), dtype=np.float32)
+
+    maps = {}
+    for name, values in (
+        ("fa", fractional_anisotropy(evals)),
+        ("md", mean_diffusivity(evals)),
+        ("ad", axial_diffusivity(evals)),
+        ("rd", radial_diffusivity(evals)),
+    ):
+        volume = np.zeros(inside.shape, dtype=np.float32)
+        volume[inside] = values
+        maps[name] = volume
+    v1 = np.zeros(inside.shape + (3,), dtype=np.float32)
+    v1[inside] = evecs[..., 0]
+    maps["v1"] = v1
+    return maps
+
+
+def load_runs(bias_corr_paths, bvals_paths, bvecs_paths):
+    """
+    Load one or more preprocessed DWI runs and concatenate them, with their
+    gradient tables, along the volume axis. Runs must already be aligned on
+    one voxel grid (see dwi_align_runs).
+
+    Returns:
+    - bias_corr: nibabel image of the first run (for the affine).
+    - data: float32 4D numpy array of all volumes.
+    - bvals, bvecs: concatenated gradient table.
+    """
+    images, bvals, bvecs = [], [], []
+    for image_path, bval_path, bvec_path in zip(bias_corr_paths, bvals_paths, bvecs_paths):
+        images.append(nib.load(image_path))
+        run_bvals, run_bvecs = read_bvals_bvecs(bval_path, bvec_path)
+        bvals.append(run_bvals)
+        bvecs.append(run_bvecs)
+    for img in images[1:]:
+        if img.shape[:3] != images[0].shape[:3] or not np.allclose(img.affine, images[0].affine, atol=1e-3):
+            raise ValueError("DWI runs are not on one voxel grid; align them to the reference run first")
+    data = np.concatenate([np.asarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3] + (-1,))
+                           for img in images], axis=-1)
+    return images[0], data, np.concatenate(bvals), np.concatenate(bvecs)
+
+
 # ----- Function: FA/MD Estimation -----
-def compute_fa_md(bias_corr_path, mask_path, moving_bval, moving_bvec):
-    bias_corr = nib.load(bias_corr_path)
+def compute_fa_md(bias_corr_path, mask_path, moving_bval, moving_bvec, chunk_size=20000, workers=1):
+    """
+    Fit the tensor and write the scalar maps. bias_corr_path, moving_bval
+    and moving_bvec may be single paths or lists of paths, one per aligned
+    run; runs and shells are concatenated (see load_runs) only for this fit.
+    """
+    if isinstance(bias_corr_path, str):
+        bias_corr_path, moving_bval, moving_bvec = [bias_corr_path], [moving_bval], [moving_bvec]
+    if not len(bias_corr_path) == len(moving_bval) == len(moving_bvec):
+        raise ValueError("Every DWI run needs its own bval and bvec file")
+    bias_corr, data, bvals, bvecs = load_runs(bias_corr_path, moving_bval, moving_bvec)
     mask = nib.load(mask_path)
-    masked_data = bias_corr.get_fdata() * mask.get_fdata()[..., None]
-    gtab = gradient_table(moving_bval, moving_bvec)
-    tensor_model = TensorModel(gtab)
-    tensor_fit = tensor_model.fit(masked_data)
-    fa = tensor_fit.fa
-    md = tensor_fit.md
+    if mask.shape[:3] != bias_corr.shape[:3]:
+        raise ValueError(f"Mask grid {mask.shape[:3]} does not match the DWI grid {bias_corr.shape[:3]}")
+    maps = fit_tensor_masked(data, np.asarray(mask.dataobj), bvals, bvecs,
+                             chunk_size=chunk_size, workers=workers)
+    del data
     fa_path = "fa_map.nii.gz"
     md_path = "md_map.nii.gz"
-    nib.save(nib.Nifti1Image(fa, bias_corr.affine), fa_path)
-    nib.save(nib.Nifti1Image(md, bias_corr.affine), md_path)
+    for name, volume in maps.items():
+        nib.save(nib.Nifti1Image(volume, bias_corr.affine), f"{name}_map.nii.gz")
     return fa_path, md_path
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Compute FA and MD maps using bias-corrected DWI and a brain mask."
     )
-    parser.add_argument("--bias_corr", type=str, required=True,
-                        help="Path to the bias-corrected DWI image (NIfTI file).")
+    parser.add_argument("--bias_corr", type=str, nargs="+", required=True,
+                        help="Path(s) to the bias-corrected DWI image(s) (NIfTI), one per run, "
+                             "aligned on one grid.")
     parser.add_argument("--mask", type=str, required=True,
-                        help="Path to the brain mask image (NIfTI file).")
-    parser.add_argument("--bval", type=str, required=True,
-                        help="Path to the bvals file.")
-    parser.add_argument("--bvec", type=str, required=True,
-                        help="Path to the bvecs file.")
+                        help="Path to the brain mask image (NIfTI file) on the DWI grid.")
+    parser.add_argument("--bval", type=str, nargs="+", required=True,
+                        help="Path(s) to the bvals file(s), in the order of --bias_corr.")
+    parser.add_argument("--bvec", type=str, nargs="+", required=True,
+                        help="Path(s) to the bvecs file(s), in the order of --bias_corr.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes fitting voxel chunks (default: all CPUs).")
+    parser.add_argument("--chunk_size", type=int, default=20000,
+                        help="Number of voxels per tensor fit.")
     args = parser.parse_args()
-    
-    fa_path, md_path = compute_fa_md(args.bias_corr, args.mask, args.bval, args.bvec)
+
+    fa_path, md_path = compute_fa_md(args.bias_corr, args.mask, args.bval, args.bvec,
+                                     chunk_size=args.chunk_size, workers=args.workers)
     print("FA map saved as:", fa_path)
-    print("MD map saved as:", md_path)
\ No newline at end of file
+    print("MD map saved as:", md_path)
@@ -1,20 +1,232 @@
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
 import nibabel as nib
-from dipy.denoise.patch2self import patch2self
+import numpy as np
 from dipy.io.gradients import read_bvals_bvecs
 
+# Rough number of slab-sized float32 buffers a worker holds at once (input
+# copy, prediction, result in transit).
+SLAB_COPIES = 4
+
+# Per-process state of the pool workers, set once by _init_worker.
+_worker = {}
+
+
+def _ols_predict(signals, rows=65536):
+    """
+    Patch2Self OLS step for one group of volumes (b0s or DWIs).
+
+    Every volume is regressed on all other volumes of the group plus an
+    intercept. The Gram matrix is shared by all fits, so it is accumulated
+    once (in float64, over row chunks) and each fit only solves a small
+    system; all predictions are then a single float32 matrix product.
+
+    Parameters:
+    - signals: float32 array (n_vox, n_group).
+    - rows: int, row chunk used to accumulate the Gram matrix.
+
+    Returns:
+    - pred: float32 array (n_vox, n_group) of the denoised signals.
+    """
+    n_vox, n_group = signals.shape
+    gram = np.zeros((n_group + 1, n_group + 1), dtype=np.float64)
+    for r0 in range(0, n_vox, rows):
+        block = np.ones((min(rows, n_vox - r0), n_group + 1), dtype=np.float64)
+        block[:, :n_group] = signals[r0:r0 + rows]
+        gram += block.T @ block
+
+    coefs = np.zeros((n_group + 1, n_group), dtype=np.float64)
+    for k in range(n_group):
+        others = np.r_[np.arange(k), np.arange(k + 1, n_group + 1)]
+        beta = np.linalg.lstsq(gram[np.ix_(others, others)], gram[others, k], rcond=None)[0]
+        coefs[others, k] = beta
+
+    pred = signals @ coefs[:n_group].astype(np.float32)
+    pred += coefs[n_group].astype(np.float32)
+    return pred
+
+
+def denoise_block(block, groups):
+    """
+    Denoise a 4D block with per-volume OLS regressions.
+
+    Parameters:
+    - block: float32 array (nx, ny, nz, nvol).
+    - groups: list of index arrays; each group is denoised on its own and
+      volumes not in any group are copied unchanged.
+
+    Returns:
+    - out: float32 array with the shape of block.
+    """
+    signals = block.reshape(-1, block.shape[-1])
+    out = signals.copy()
+    for idx in groups:
+        out[:, idx] = _ols_predict(np.ascontiguousarray(signals[:, idx]))
+    return out.reshape(block.shape)
+
+
+def slab_weights(z0, z1, core0, core1):
+    """
+    Blending weights along z of an extended slab [z0, z1) whose core is
+    [core0, core1): 1 inside the core, ramping linearly towards 0 across the
+    overlap so that neighbouring slabs are stitched without seams.
+    """
+    z = np.arange(z0, z1, dtype=np.float32)
+    w = np.ones(z1 - z0, dtype=np.float32)
+    if core0 > z0:
+        w = np.where(z < core0, (z - z0 + 1) / (core0 - z0 + 1), w)
+    if z1 > core1:
+        w = np.where(z >= core1, (z1 - z) / (z1 - core1 + 1), w)
+    return w
+
+
+def plan_slabs(shape, slab=None, overlap=4, workers=1, mem_limit=None):
+    """
+    Choose the slab thickness and number of workers.
+
+    Without a slab thickness the z-axis is split evenly over the workers.
+    With mem_limit (GB) the parent's full copies are reserved first (input
+    and output, plus the shared-memory block when workers > 1) and slabs
+    (including overlap) are thinned, then workers dropped, until every
+    worker's slab buffers fit in the remaining budget.
+
+    Returns:
+    - slab: int, core slab thickness in slices.
+    - workers: int, number of workers to use.
+    """
+    nz = shape[2]
+    workers = max(1, workers)
+    if slab is None:
+        slab = int(np.ceil(nz / workers))
+    slab = max(1, min(slab, nz))
+    if mem_limit is None:
+        return slab, workers
+
+    slice_bytes = 4 * shape[0] * shape[1] * shape[3]
+    while workers >= 1:
+        full_copies = 3 if workers > 1 else 2
+        budget = mem_limit * 1024 ** 3 - full_copies * slice_bytes * nz
+        fit = int(budget // (workers * SLAB_COPIES * slice_bytes)) - 2 * overlap
+        if fit >= 1:
+            return min(slab, fit), workers
+        workers -= 1
+    raise MemoryError(
+        f"--mem_limit {mem_limit} GB cannot hold the data ({2 * slice_bytes * nz / 1024 ** 3:.2f} GB "
+        f"for input and output, serially) plus one slab of {1 + 2 * overlap} slices"
+    )
+
+
+def _init_worker(shm_name, shape, groups):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker["shm"] = shm
+    _worker["data"] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    _worker["groups"] = groups
+
+
+def _denoise_slab(i, z0, z1):
+    return i, denoise_block(np.array(_worker["data"][:, :, z0:z1]), _worker["groups"])
+
+
+def patch2self_slabs(data, bvals, b0_threshold=50, b0_denoising=False, shift_intensity=True,
+                     clip_negative_vals=False, slab=None, overlap=4, workers=1, mem_limit=None):
+    """
+    Patch2Self (OLS, voxel-wise) on overlapping z-slabs across a process pool.
+
+    Each slab is extended by `overlap` slices on both sides, every volume is
+    regressed on the other volumes of its shell group within that slab, and
+    the slab predictions are blended in the overlaps. Data stays float32 and
+    the 4D array is shared with the workers instead of copied.
+    With a single slab this is the plain OLS Patch2Self fit.
+
+    Parameters:
+    - data: 4D numpy array.
+    - bvals: numpy array of b-values.
+    - b0_threshold: float, volumes with bval <= b0_threshold are b0s.
+    - b0_denoising: bool, also denoise the b0s (needs at least two).
+    - shift_intensity: bool, shift each volume so its minimum matches the input.
+    - clip_negative_vals: bool, set negative values to 0 (takes precedence).
+    - slab: int or None, core slab thickness in slices.
+    - overlap: int, slices shared with each neighbouring slab.
+    - workers: int, number of worker processes.
+    - mem_limit: float or None, memory ceiling in GB (see plan_slabs).
+
+    Returns:
+    - denoised: float32 numpy array with the shape of data.
+    """
+    bvals = np.asarray(bvals)
+    b0_idx = np.flatnonzero(bvals <= b0_threshold)
+    dwi_idx = np.flatnonzero(bvals > b0_threshold)
+    groups = [dwi_idx]
+    if b0_denoising and len(b0_idx) > 1:
+        groups.append(b0_idx)
+    groups = [idx for idx in groups if len(idx) > 1]
+
+    nz = data.shape[2]
+    slab, workers = plan_slabs(data.shape, slab, overlap, workers, mem_limit)
+    slabs = []
+    for core0 in range(0, nz, slab):
+        core1 = min(core0 + slab, nz)
+        slabs.append((max(0, core0 - overlap), min(nz, core1 + overlap), core0, core1))
+    print(f"Patch2Self: {len(slabs)} slab(s) of {slab} slices (+{overlap} overlap), {workers} worker(s)")
+
+    denoised = np.zeros(data.shape, dtype=np.float32)
+    weight_sum = np.zeros(nz, dtype=np.float32)
+
+    def accumulate(i, block):
+        z0, z1 = slabs[i][:2]
+        w = slab_weights(*slabs[i])
+        block *= w[None, None, :, None]
+        denoised[:, :, z0:z1] += block
+        weight_sum[z0:z1] += w
+
+    if workers == 1 or len(slabs) == 1:
+        for i, (z0, z1, _, _) in enumerate(slabs):
+            accumulate(i, denoise_block(np.asarray(data[:, :, z0:z1], dtype=np.float32), groups))
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=4 * int(np.prod(data.shape)))
+        try:
+            shared = np.ndarray(data.shape, dtype=np.float32, buffer=shm.buf)
+            shared[...] = data
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(shm.name, data.shape, groups),
+            ) as pool:
+                futures = [pool.submit(_denoise_slab, i, z0, z1) for i, (z0, z1, _, _) in enumerate(slabs)]
+                for future in as_completed(futures):
+                    accumulate(*future.result())
+        finally:
+            shm.close()
+            shm.unlink()
+    denoised /= weight_sum[None, None, :, None]
+
+    if clip_negative_vals:
+        np.clip(denoised, 0, None, out=denoised)
+    elif shift_intensity:
+        for i in range(denoised.shape[-1]):
+            denoised[..., i] += np.min(data[..., i]) - np.min(denoised[..., i])
+    return denoised
+
+
 # ----- Function: Denoise -----
-def run_denoise(moving, moving_bval, moving_bvec):
+def run_denoise(moving, moving_bval, moving_bvec, slab=None, overlap=4, workers=1, mem_limit=None):
     moving_image = nib.load(moving)
     moving_bval_value, moving_bvec_value = read_bvals_bvecs(moving_bval, moving_bvec)
-    denoised = patch2self(
-        moving_image.get_fdata(),
+    denoised = patch2self_slabs(
+        np.asarray(moving_image.dataobj, dtype=np.float32),
         moving_bval_value,
-        model="ols",
         shift_intensity=True,
         clip_negative_vals=False,
         b0_threshold=50,
         b0_denoising=False,
+        slab=slab,
+        overlap=overlap,
+        workers=workers,
+        mem_limit=mem_limit,
     )
     out_path = "denoised_moving.nii.gz"
     nib.save(nib.Nifti1Image(denoised, moving_image.affine), out_path)
@@ -30,7 +242,16 @@ if __name__ == "__main__":
                         help="Path to the bvals file.")
     parser.add_argument("--bvec", type=str, required=True,
                         help="Path to the bvecs file.")
-    
+    parser.add_argument("--slab", type=int, default=None,
+                        help="Slab thickness in slices (default: z-axis split over the workers).")
+    parser.add_argument("--overlap", type=int, default=4,
+                        help="Slices shared between neighbouring slabs (default: 4).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes denoising slabs in parallel.")
+    parser.add_argument("--mem_limit", type=float, default=None,
+                        help="Memory ceiling in GB; slabs and workers are reduced to fit.")
+
     args = parser.parse_args()
-    output_path = run_denoise(args.moving, args.bval, args.bvec)
-    print("Denoised image saved as:", output_path)
\ No newline at end of file
+    output_path = run_denoise(args.moving, args.bval, args.bvec, slab=args.slab,
+                              overlap=args.overlap, workers=args.workers, mem_limit=args.mem_limit)
+    print("Denoised image saved as:", output_path)
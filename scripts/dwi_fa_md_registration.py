@@ -4,11 +4,16 @@ import nibabel as nib
 import numpy as np
 import ants
 import argparse
+from atlas_cache import atlas_ants, load_atlas
 
 # ----- Function: Apply Registration to FA/MD Maps -----
-def apply_registration_to_fa_md(fa_path, md_path, atlas, reg_affine, mapping, md_out_path, fa_out_path):
+def apply_registration_to_fa_md(fa_path, md_path, atlas, reg_affine, mapping, md_out_path, fa_out_path,
+                                atlas_cache=None):
     # Load the images
-    MNI_atlas = ants.image_read(atlas)
+    if atlas_cache:
+        MNI_atlas = atlas_ants(load_atlas(atlas, atlas_cache))
+    else:
+        MNI_atlas = ants.image_read(atlas)
     fa_map = ants.image_read(fa_path)
     md_map = ants.image_read(md_path)
     
@@ -48,7 +53,10 @@ if __name__ == "__main__":
                         help="Output path for the registered FA maps.")
     parser.add_argument("--out_md", type=str, required=True,
                         help="Output path for the registered MD maps.")
+    parser.add_argument("--atlas_cache", type=str, default=None,
+                        help="Optional shared atlas cache directory.")
     
     args = parser.parse_args()
     
-    apply_registration_to_fa_md(args.fa, args.md, args.atlas, args.reg_affine, args.mapping, args.out_md, args.out_fa)
\ No newline at end of file
+    apply_registration_to_fa_md(args.fa, args.md, args.atlas, args.reg_affine, args.mapping, args.out_md, args.out_fa,
+                                atlas_cache=args.atlas_cache)
\ No newline at end of file
@@ -0,0 +1,166 @@
+import argparse
+import csv
+import glob
+import json
+import os
+
+import numpy as np
+
+MANIFEST_COLUMNS = [
+    "run_id", "dwi", "bval", "bvec", "acq", "dir", "run", "shells", "n_volumes",
+    "PhaseEncodingDirection", "TotalReadoutTime",
+    "reverse_dwi", "reverse_bval", "reverse_bvec", "reference",
+]
+
+# Fallback when a sidecar has no PhaseEncodingDirection: dir-<label> names the
+# direction of travel, so AP runs along -j and PA along +j.
+DIR_TO_PE = {"AP": "j-", "PA": "j", "LR": "i-", "RL": "i", "SI": "k-", "IS": "k"}
+
+
+def parse_entities(path):
+    """
+    BIDS entities of a file name, e.g. {'sub': 'HC131', 'acq': 'b700-41', ...}.
+    Labels are split on the first '-' only, so hyphenated labels survive.
+    """
+    name = os.path.basename(path).split(".")[0]
+    entities = {}
+    for part in name.split("_")[:-1]:
+        if "-" in part:
+            key, value = part.split("-", 1)
+            entities[key] = value
+    return entities
+
+
+def read_sidecar(nifti_path):
+    sidecar = nifti_path[: -len(".nii.gz")] + ".json" if nifti_path.endswith(".nii.gz") \
+        else os.path.splitext(nifti_path)[0] + ".json"
+    if not os.path.exists(sidecar):
+        return {}
+    with open(sidecar) as f:
+        return json.load(f)
+
+
+def opposite_pe(pe):
+    return pe[:-1] if pe.endswith("-") else pe + "-"
+
+
+def reference_order(row):
+    """
+    Sort key of the reference-run rule: lowest non-zero shell first, then
+    the most volumes, then file-name order (sort is stable).
+    """
+    shells = [int(s) for s in row["shells"].split(",") if int(s) > 0]
+    return min(shells), -int(row["n_volumes"])
+
+
+def index_dwi(bids_dir, subject, session, b0_threshold=50, reference_acq=None):
+    """
+    Describe every DWI acquisition of a session and pair it with a
+    reverse phase-encoded partner.
+
+    An acquisition with at least one volume above b0_threshold is a run to
+    process; acquisitions with only b0 volumes are only used as partners.
+    The partner of a run has the opposite PhaseEncodingDirection, preferring
+    b0-only acquisitions, then the same acq and run labels.
+
+    Exactly one run with a partner is flagged as the reference run, the space
+    of the DWI mask, FA/MD maps and registrations. It is chosen by content:
+    the run with the lowest non-zero shell (e.g. acq-b700 over acq-b2000),
+    then the one with the most volumes, then the first in file-name order.
+    reference_acq overrides the rule with the first such run of that acq label.
+
+    Parameters:
+    - bids_dir: BIDS root directory.
+    - subject, session: full labels, e.g. "sub-HC131" and "ses-01".
+    - b0_threshold: float, b-values at or below this are b0.
+    - reference_acq: str or None, acq label of the reference run.
+
+    Returns:
+    - rows: list of dicts with MANIFEST_COLUMNS, one per run.
+    """
+    dwi_dir = os.path.join(bids_dir, subject, session, "dwi")
+    acquisitions = []
+    for nifti in sorted(glob.glob(os.path.join(dwi_dir, "*_dwi.nii.gz"))):
+        stem = nifti[: -len(".nii.gz")]
+        bval, bvec = stem + ".bval", stem + ".bvec"
+        if not (os.path.exists(bval) and os.path.exists(bvec)):
+            print(f"Skipping {nifti}: missing .bval/.bvec")
+            continue
+        entities = parse_entities(nifti)
+        sidecar = read_sidecar(nifti)
+        bvals = np.loadtxt(bval, ndmin=1)
+        pe = sidecar.get("PhaseEncodingDirection") or DIR_TO_PE.get(entities.get("dir", "").upper(), "")
+        shells = np.unique(np.where(bvals <= b0_threshold, 0, np.round(bvals, -2))).astype(int)
+        acquisitions.append({
+            "run_id": "_".join(f"{k}-{v}" for k, v in entities.items() if k not in ("sub", "ses")) or "dwi",
+            "dwi": os.path.abspath(nifti),
+            "bval": os.path.abspath(bval),
+            "bvec": os.path.abspath(bvec),
+            "acq": entities.get("acq", ""),
+            "dir": entities.get("dir", ""),
+            "run": entities.get("run", ""),
+            "shells": ",".join(str(s) for s in shells),
+            "n_volumes": len(bvals),
+            "PhaseEncodingDirection": pe,
+            "TotalReadoutTime": sidecar.get("TotalReadoutTime", ""),
+            "b0_only": bool(np.all(bvals <= b0_threshold)),
+        })
+
+    rows = []
+    for acq in acquisitions:
+        if acq["b0_only"]:
+            continue
+        candidates = [other for other in acquisitions
+                      if other is not acq and acq["PhaseEncodingDirection"]
+                      and other["PhaseEncodingDirection"] == opposite_pe(acq["PhaseEncodingDirection"])]
+        candidates.sort(key=lambda other: (not other["b0_only"], other["acq"] != acq["acq"],
+                                           other["run"] != acq["run"]))
+        partner = candidates[0] if candidates else None
+        if partner is None:
+            print(f"No reverse phase-encoded partner for {acq['dwi']}")
+        row = {key: acq[key] for key in MANIFEST_COLUMNS if key in acq}
+        row["reverse_dwi"] = partner["dwi"] if partner else "n/a"
+        row["reverse_bval"] = partner["bval"] if partner else "n/a"
+        row["reverse_bvec"] = partner["bvec"] if partner else "n/a"
+        row["reference"] = 0
+        rows.append(row)
+
+    candidates = [row for row in rows if row["reverse_dwi"] != "n/a"]
+    if reference_acq:
+        candidates = [row for row in candidates if row["acq"] == reference_acq]
+        if not candidates:
+            raise ValueError(f"No DWI run with acq-{reference_acq} and a reverse phase-encoded partner")
+    if candidates:
+        min(candidates, key=reference_order)["reference"] = 1
+    return rows
+
+
+def write_manifest(rows, out_path):
+    with open(out_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(rows)
+    return out_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the DWI runs of a BIDS session into a TSV manifest."
+    )
+    parser.add_argument("--bids_dir", type=str, required=True,
+                        help="BIDS root directory.")
+    parser.add_argument("--subject", type=str, required=True,
+                        help="Subject label including the prefix (e.g. sub-HC131).")
+    parser.add_argument("--session", type=str, required=True,
+                        help="Session label including the prefix (e.g. ses-01).")
+    parser.add_argument("--b0_threshold", type=float, default=50,
+                        help="b-values at or below this are treated as b0 (default: 50).")
+    parser.add_argument("--reference_acq", type=str, default=None,
+                        help="acq label of the reference run (default: lowest non-zero shell, "
+                             "then most volumes).")
+    parser.add_argument("--out", type=str, default="dwi_manifest.tsv",
+                        help="Output manifest path.")
+    args = parser.parse_args()
+
+    rows = index_dwi(args.bids_dir, args.subject, args.session, args.b0_threshold, args.reference_acq)
+    write_manifest(rows, args.out)
+    print(f"Indexed {len(rows)} DWI run(s) into {args.out}")
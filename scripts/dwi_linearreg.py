@@ -6,8 +6,10 @@ from dipy.align import register_dwi_to_template
 import ants
 from tqdm import tqdm
 import shutil
+from atlas_cache import atlas_ants, atlas_nifti, load_atlas
 
-def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=None, rev_affine_file=None):
+def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=None, rev_affine_file=None,
+        atlas_cache=None):
     """
     Replace the previous motion correction logic with the QuickSyN-based 
     registration you provided for each volume in the DWI.
@@ -16,8 +18,10 @@ def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=No
     dwi_ants = ants.image_read(dwi_path)
     dwi_data = dwi_ants.numpy()
 
-    atlas_ants = ants.image_read(atlas_path)    
-    atlas_data = atlas_ants.numpy()
+    if atlas_cache:
+        atlas_img = atlas_ants(load_atlas(atlas_path, atlas_cache))
+    else:
+        atlas_img = ants.image_read(atlas_path)
     
     # B0 is assumed to be the first volume (index 0)
     b0_data = dwi_data[..., 0]
@@ -30,13 +34,13 @@ def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=No
  
     # Rigid registration
     rigid_reg = ants.registration(
-        fixed=atlas_ants,
+        fixed=atlas_img,
         moving=b0_ants,
         type_of_transform='QuickRigid'
     )
     # Non-linear registration (SyNOnly) using the rigid transform as initial
     quicksyn_reg = ants.registration(
-        fixed=atlas_ants,
+        fixed=atlas_img,
         moving=rigid_reg['warpedmovout'],
         initial_transform=rigid_reg['fwdtransforms'][0],
         type_of_transform='SyNOnly'
@@ -60,7 +64,7 @@ def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=No
 
 
 # ----- Function: Linear Registration -----
-def run_linear_registration(bias_corr_path, moving_bval, moving_bvec, atlas, affine_path):
+def run_linear_registration(bias_corr_path, moving_bval, moving_bvec, atlas, affine_path, atlas_cache=None):
     # Linear registration to atlas
     pipeline = ["center_of_mass", "translation", "rigid", "affine"]
     level_iters = [500, 100, 50]    # Adjusted parameters
@@ -68,7 +72,10 @@ def run_linear_registration(bias_corr_path, moving_bval, moving_bvec, atlas, aff
     factors = [8, 4, 2]
     
     bias_corr = nib.load(bias_corr_path)
-    MNI_atlas = nib.load(atlas)
+    if atlas_cache:
+        MNI_atlas = atlas_nifti(load_atlas(atlas, atlas_cache))
+    else:
+        MNI_atlas = nib.load(atlas)
     xformed_dwi, reg_affine = register_dwi_to_template(
         dwi=bias_corr,
         gtab=gradient_table(moving_bval, moving_bvec),
@@ -103,8 +110,11 @@ if __name__ == "__main__":
                         help="Path for the affine output.")
     parser.add_argument("--rev_warpfield", type=str, required=True,
                         help="Path for the affine output.")
+    parser.add_argument("--atlas_cache", type=str, default=None,
+                        help="Optional shared atlas cache directory.")
     
     args = parser.parse_args()
-    run(args.bias_corr, args.atlas, args.warpfield, args.affine, args.rev_warpfield, args.rev_affine)
+    run(args.bias_corr, args.atlas, args.warpfield, args.affine, args.rev_warpfield, args.rev_affine,
+        atlas_cache=args.atlas_cache)
     print("Registration complete.")
     
\ No newline at end of file
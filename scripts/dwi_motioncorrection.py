@@ -1,55 +1,225 @@
 import argparse
+import csv
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
 import ants
 import numpy as np
 from tqdm import tqdm
 
-def run_motion_correction(dwi_path, bval_path, bvec_path):
+# Linear stage used by each transform model, and whether SyNOnly follows it.
+TRANSFORMS = {
+    "rigid": ("QuickRigid", False),
+    "affine": ("AffineFast", False),
+    "rigid+syn": ("QuickRigid", True),
+    "affine+syn": ("AffineFast", True),
+}
+
+MOTION_COLUMNS = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+
+# Per-process state of the pool workers, set once by _init_worker.
+_worker = {}
+
+
+def motion_parameters(transform_path):
+    """
+    Rigid motion parameters of an ANTs linear transform.
+
+    The rotation is the closest rotation to the 3x3 matrix (polar
+    decomposition), so the same code serves rigid and affine models.
+
+    Returns:
+    - list of [trans_x, trans_y, trans_z] (mm) and [rot_x, rot_y, rot_z] (rad).
     """
-    Replace the previous motion correction logic with the QuickSyN-based 
-    registration you provided for each volume in the DWI.
+    params = np.asarray(ants.read_transform(transform_path).parameters, dtype=np.float64)
+    matrix = params[:9].reshape(3, 3)
+    translation = params[9:12]
+    u, _, vt = np.linalg.svd(matrix)
+    rot = u @ vt
+    rot_x = np.arctan2(rot[2, 1], rot[2, 2])
+    rot_y = np.arctan2(-rot[2, 0], np.hypot(rot[2, 1], rot[2, 2]))
+    rot_z = np.arctan2(rot[1, 0], rot[0, 0])
+    return list(translation) + [rot_x, rot_y, rot_z]
+
+
+def register_volume_to_b0(b0_ants, moving_data, origin, spacing, transform="rigid+syn",
+                          mask=None, initial_transform=None):
+    """
+    Register one 3D volume to the b0.
+
+    Parameters:
+    - b0_ants: ANTsImage of the b0.
+    - moving_data: numpy array of the volume to register.
+    - origin, spacing: geometry of the volume.
+    - transform: str, one of TRANSFORMS.
+    - mask: ANTsImage or None, b0 brain mask restricting the metric.
+    - initial_transform: str or None, linear transform used as a warm start
+      (typically the solution of the temporally neighbouring volume).
+
+    Returns:
+    - warped: numpy array of the registered volume on the b0 grid.
+    - linear_transform: path of the linear transform (for warm starts and
+      motion parameters).
+    """
+    linear_type, run_syn = TRANSFORMS[transform]
+    moving_ants = ants.from_numpy(
+        moving_data,
+        origin=origin,
+        spacing=spacing
+    )
+
+    linear_reg = ants.registration(
+        fixed=b0_ants,
+        moving=moving_ants,
+        type_of_transform=linear_type,
+        mask=mask,
+        initial_transform=initial_transform,
+    )
+    linear_transform = linear_reg['fwdtransforms'][0]
+    if not run_syn:
+        return linear_reg['warpedmovout'].numpy(), linear_transform
+
+    # Non-linear registration (SyNOnly) initialised with the linear transform
+    quicksyn_reg = ants.registration(
+        fixed=b0_ants,
+        moving=moving_ants,
+        initial_transform=linear_transform,
+        type_of_transform='SyNOnly',
+        mask=mask,
+    )
+    return quicksyn_reg['warpedmovout'].numpy(), linear_transform
+
+
+def register_chunk(b0_ants, dwi_data, indices, origin, spacing, transform, mask, warm_start):
+    """
+    Register consecutive volumes in order; with warm_start each volume starts
+    from the linear solution of the previous one.
+    """
+    results = []
+    previous = None
+    for idx in indices:
+        warped, linear_transform = register_volume_to_b0(
+            b0_ants, np.array(dwi_data[..., idx]), origin, spacing, transform,
+            mask=mask, initial_transform=previous if warm_start else None,
+        )
+        previous = linear_transform
+        results.append((idx, warped, motion_parameters(linear_transform)))
+    return results
+
+
+def _init_worker(shm_name, shape, dtype, origin, spacing, itk_threads):
+    # Must be set before ITK creates its first multi-threaded filter.
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(itk_threads)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    dwi_data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    b0_ants = ants.from_numpy(np.array(dwi_data[..., 0]), origin=origin, spacing=spacing)
+    _worker["shm"] = shm
+    _worker["dwi"] = dwi_data
+    _worker["origin"] = origin
+    _worker["spacing"] = spacing
+    _worker["b0"] = b0_ants
+    _worker["mask"] = ants.get_mask(b0_ants)
+
+
+def _register_chunk(indices, transform, warm_start):
+    return register_chunk(_worker["b0"], _worker["dwi"], indices, _worker["origin"],
+                          _worker["spacing"], transform, _worker["mask"], warm_start)
+
+
+def _split_chunks(indices, n_chunks):
+    return [list(chunk) for chunk in np.array_split(indices, n_chunks) if len(chunk)]
+
+
+def write_motion_tsv(motion, out_path):
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["volume"] + MOTION_COLUMNS)
+        for idx, params in enumerate(motion):
+            writer.writerow([idx] + ["%.6f" % p for p in params])
+    return out_path
+
+
+def run_motion_correction(dwi_path, bval_path, bvec_path, workers=1, threads=None,
+                          transform="rigid+syn", warm_start=True, motion_tsv="motion_parameters.tsv"):
+    """
+    Register every DWI volume to the b0 (volume 0).
+
+    Volumes are registered with the selected transform model using a b0 brain
+    mask computed once. With warm_start, volumes are processed in contiguous
+    runs and each one is initialised with its predecessor's linear transform;
+    with workers > 1 those runs are distributed over a process pool. The 4D
+    data is placed in shared memory once and each worker gets
+    threads // workers ITK threads.
+
+    Parameters:
+    - dwi_path: path to the denoised 4D DWI.
+    - bval_path, bvec_path: retained for CLI consistency (unused).
+    - workers: int, number of worker processes.
+    - threads: int or None, total thread budget (default: all CPUs).
+    - transform: str, one of TRANSFORMS.
+    - warm_start: bool, initialise each volume from its temporal neighbour.
+    - motion_tsv: str or None, path of the per-volume rigid motion parameters.
+
+    Returns:
+    - out_path: path to the motion-corrected image.
     """
     # Read the main DWI file using ANTs
     dwi_ants = ants.image_read(dwi_path)
     dwi_data = dwi_ants.numpy()
+    origin = dwi_ants.origin[:3]
+    spacing = dwi_ants.spacing[:3]
+    n_volumes = dwi_data.shape[-1]
 
     # B0 is assumed to be the first volume (index 0)
     b0_data = dwi_data[..., 0]
-    b0_ants = ants.from_numpy(
-        b0_data,
-        origin=dwi_ants.origin[:3],
-        spacing=dwi_ants.spacing[:3]
-    )
 
     registered_data = np.zeros_like(dwi_data)
     # Keep the original B0 in the first volume
     registered_data[..., 0] = b0_data
+    motion = [[0.0] * len(MOTION_COLUMNS) for _ in range(n_volumes)]
 
-    # Register each shell to B0 using a quick approach
-    for idx in tqdm(range(1, dwi_data.shape[-1]), desc="Registering volumes"):
-        moving_data = dwi_data[..., idx]
-        moving_ants = ants.from_numpy(
-            moving_data,
-            origin=dwi_ants.origin[:3],
-            spacing=dwi_ants.spacing[:3]
-        )
+    threads = threads or multiprocessing.cpu_count()
+    workers = max(1, min(workers, n_volumes - 1))
+    indices = list(range(1, n_volumes))
+    # Warm starts need consecutive volumes in one chain; without them every
+    # volume is its own task.
+    chunks = _split_chunks(indices, workers) if warm_start else [[idx] for idx in indices]
 
-        # Rigid registration
-        rigid_reg = ants.registration(
-            fixed=b0_ants,
-            moving=moving_ants,
-            type_of_transform='QuickRigid'
-        )
-        # Non-linear registration (SyNOnly) using the rigid transform as initial
-        quicksyn_reg = ants.registration(
-            fixed=b0_ants,
-            moving=rigid_reg['warpedmovout'],
-            initial_transform=rigid_reg['fwdtransforms'][0],
-            type_of_transform='SyNOnly'
-        )
-
-        # Place the registered volume in the output array
-        warped_data = quicksyn_reg['warpedmovout'].numpy()
-        registered_data[..., idx] = warped_data
+    progress = tqdm(total=len(indices), desc="Registering volumes")
+    if workers == 1:
+        b0_ants = ants.from_numpy(b0_data, origin=origin, spacing=spacing)
+        mask = ants.get_mask(b0_ants)
+        for chunk in chunks:
+            for idx, warped, params in register_chunk(b0_ants, dwi_data, chunk, origin, spacing,
+                                                      transform, mask, warm_start):
+                registered_data[..., idx] = warped
+                motion[idx] = params
+                progress.update(1)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=dwi_data.nbytes)
+        try:
+            shared = np.ndarray(dwi_data.shape, dtype=dwi_data.dtype, buffer=shm.buf)
+            shared[...] = dwi_data
+            initargs = (shm.name, dwi_data.shape, dwi_data.dtype, origin, spacing,
+                        max(1, threads // workers))
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=initargs,
+            ) as pool:
+                futures = [pool.submit(_register_chunk, chunk, transform, warm_start) for chunk in chunks]
+                for future in as_completed(futures):
+                    for idx, warped, params in future.result():
+                        registered_data[..., idx] = warped
+                        motion[idx] = params
+                        progress.update(1)
+        finally:
+            shm.close()
+            shm.unlink()
+    progress.close()
 
     # Save the registered data
     registered_ants = ants.from_numpy(
@@ -59,8 +229,10 @@ def run_motion_correction(dwi_path, bval_path, bvec_path):
     )
     out_path = "moving_motion_corrected.nii.gz"
     ants.image_write(registered_ants, out_path)
+    if motion_tsv:
+        write_motion_tsv(motion, motion_tsv)
 
-    print("Motion correction completed for all shells with QuickSyN registration.")
+    print(f"Motion correction completed for all shells ({transform}).")
     return out_path
 
 if __name__ == "__main__":
@@ -73,7 +245,21 @@ if __name__ == "__main__":
                         help="Path to the bvals file. (Currently unused, but retained for consistency.)")
     parser.add_argument("--bvec", type=str, required=True,
                         help="Path to the bvecs file. (Currently unused, but retained for consistency.)")
-    
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes registering volumes in parallel.")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Total thread budget shared by the workers (default: all CPUs).")
+    parser.add_argument("--transform", type=str, choices=list(TRANSFORMS), default="rigid+syn",
+                        help="Transform model per volume (default: rigid+syn).")
+    parser.add_argument("--no_warm_start", action="store_true",
+                        help="Do not initialise each volume from its neighbour's transform.")
+    parser.add_argument("--motion_tsv", type=str, default="motion_parameters.tsv",
+                        help="Output path for the per-volume motion parameters.")
+
     args = parser.parse_args()
-    corrected_image = run_motion_correction(args.denoised, args.bval, args.bvec)
+    corrected_image = run_motion_correction(args.denoised, args.bval, args.bvec,
+                                            workers=args.workers, threads=args.threads,
+                                            transform=args.transform,
+                                            warm_start=not args.no_warm_start,
+                                            motion_tsv=args.motion_tsv)
     print("Motion corrected image saved as:", corrected_image)
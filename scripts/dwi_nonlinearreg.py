@@ -1,14 +1,15 @@
 import nibabel as nib
 from dipy.align.metrics import CCMetric  # cross-correlation metric
-from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
 import argparse
+from atlas_cache import atlas_nifti, load_atlas
+from syn_schedule import PRESETS, make_sdr
+from warp_quality import analyse_warp, write_report
 
 # ----- Function: Nonlinear Registration -----
-def run_nonlinear_registration(MNI_atlas, fixed_xformed_path, warp_path):
+def run_nonlinear_registration(MNI_atlas, fixed_xformed_path, warp_path, schedule="default"):
     fixed_xformed = nib.load(fixed_xformed_path)
     metric = CCMetric(3)
-    level_iters = [1000, 100, 10]
-    sdr = SymmetricDiffeomorphicRegistration(metric, level_iters)
+    sdr = make_sdr(metric, schedule)
     mapping = sdr.optimize(MNI_atlas.get_fdata(), fixed_xformed.get_fdata())
     nonlinear_transform = mapping.transform(fixed_xformed.get_fdata())
     nib.save(nib.Nifti1Image(nonlinear_transform, MNI_atlas.affine), "nonlinear_transform.nii.gz")
@@ -26,10 +27,24 @@ if __name__ == "__main__":
                         help="Path to the fixed transformed image (NIfTI file).")
     parser.add_argument("--warp", type=str, required=True,
                         help="Path to the fixed transformed image (NIfTI file).")
+    parser.add_argument("--atlas_cache", type=str, default=None,
+                        help="Optional shared atlas cache directory.")
+    parser.add_argument("--schedule", type=str, choices=sorted(PRESETS), default="default",
+                        help="SyN iteration schedule; levels also stop early on energy plateaus.")
+    parser.add_argument("--qc_json", type=str, default=None,
+                        help="Optional path for a warp-quality report of the forward/backward fields.")
     args = parser.parse_args()
     
-    MNI_atlas = nib.load(args.atlas)
-    run_nonlinear_registration(MNI_atlas, args.fixed, args.warp)
+    if args.atlas_cache:
+        MNI_atlas = atlas_nifti(load_atlas(args.atlas, args.atlas_cache))
+    else:
+        MNI_atlas = nib.load(args.atlas)
+    run_nonlinear_registration(MNI_atlas, args.fixed, args.warp, args.schedule)
+    if args.qc_json:
+        report = analyse_warp("forward_MNI_warp.nii.gz", args.warp)
+        write_report(report, args.qc_json)
+        if not report["ok"]:
+            print("WARNING: warp quality flagged:", ", ".join(report["flags"]))
     print("Nonlinear registration complete. Outputs saved as:")
     print(" - nonlinear_transform.nii.gz")
     print(" - forward_MNI_warp.nii.gz")
@@ -7,10 +7,14 @@ import ants
 from tqdm import tqdm
 import shutil
 
-def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=None, rev_affine_file=None):
+def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=None, rev_affine_file=None,
+        backend="ants", model_file=None):
     """
     Replace the previous motion correction logic with the QuickSyN-based 
     registration you provided for each volume in the DWI.
+
+    backend="voxelmorph" swaps SyNRA for an affine + VoxelMorph forward pass
+    using the model in model_file.
     """
     # Read the main DWI file using ANTs
     dwi_ants = ants.image_read(dwi_path)
@@ -27,8 +31,13 @@ def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=No
     )
 
     
-    # 'SyN' transform includes both linear and nonlinear registration.
-    transforms = ants.registration(fixed=atlas_ants, moving=b0_ants, type_of_transform="SyNRA")
+    if backend == "voxelmorph":
+        from vxm_registration import voxelmorph_registration
+
+        transforms = voxelmorph_registration(atlas_ants, b0_ants, model_file)
+    else:
+        # 'SyN' transform includes both linear and nonlinear registration.
+        transforms = ants.registration(fixed=atlas_ants, moving=b0_ants, type_of_transform="SyNRA")
 
     # The result of the registration is a dictionary containing, among other keys:
     # 'warpedmovout' and 'fwdtransforms' (list of transform paths generated).
@@ -36,6 +45,7 @@ def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=No
 
     # If specified, save the transform files
     # Typically, transforms["fwdtransforms"][0] is the warp field, and [1] is the affine.
+    # The inverse list is reversed: [0] is the affine and [1] the inverse warp field.
     if warp_file:
         shutil.copyfile(transforms["fwdtransforms"][0], warp_file)
         print(f"Saved warp field as {warp_file}")
@@ -43,10 +53,10 @@ def run(dwi_path, atlas_path, warp_file=None, affine_file=None, rev_warp_file=No
         shutil.copyfile(transforms["fwdtransforms"][1], affine_file)
         print(f"Saved affine transform as {affine_file}")
     if rev_warp_file:
-        shutil.copyfile(transforms["invtransforms"][0], rev_warp_file)
+        shutil.copyfile(transforms["invtransforms"][1], rev_warp_file)
         print(f"Saved reverse warp field as {rev_warp_file}")
     if rev_affine_file:
-        shutil.copyfile(transforms["invtransforms"][1], rev_affine_file)
+        shutil.copyfile(transforms["invtransforms"][0], rev_affine_file)
         print(f"Saved reverse affine transform as {rev_affine_file}")
         
 
@@ -97,8 +107,15 @@ if __name__ == "__main__":
                         help="Path for the affine output.")
     parser.add_argument("--rev_warpfield", type=str, required=True,
                         help="Path for the affine output.")
+    parser.add_argument("--backend", type=str, choices=["ants", "voxelmorph"], default="ants",
+                        help="Nonlinear registration backend: ANTs SyNRA or a VoxelMorph model.")
+    parser.add_argument("--model", type=str, default=None,
+                        help="Path to the VoxelMorph pytorch model (required with --backend voxelmorph).")
     
     args = parser.parse_args()
-    run(args.moving, args.fixed, args.warpfield, args.affine, args.rev_warpfield, args.rev_affine)
+    if args.backend == "voxelmorph" and not args.model:
+        parser.error("--model is required with --backend voxelmorph")
+    run(args.moving, args.fixed, args.warpfield, args.affine, args.rev_warpfield, args.rev_affine,
+        backend=args.backend, model_file=args.model)
     print("Registration complete.")
     
\ No newline at end of file
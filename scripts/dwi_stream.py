@@ -0,0 +1,168 @@
+import argparse
+import os
+import tempfile
+
+import ants
+import nibabel as nib
+import numpy as np
+from tqdm import tqdm
+
+from dwi_biascorrection import bias_field_of_volume
+from dwi_motioncorrection import (MOTION_COLUMNS, TRANSFORMS, motion_parameters,
+                                  register_volume_to_b0, write_motion_tsv)
+from yaxis_warp import apply_y_table, y_interpolation_table
+
+
+def iter_volumes(img):
+    """
+    Yield (index, float32 3D volume) of a 4D image one volume at a time.
+
+    Parameters:
+    - img: nibabel image, ideally loaded with keep_file_open=True so that a
+      compressed file is decompressed once while the volumes are read in order.
+    """
+    for idx in range(img.shape[-1]):
+        yield idx, np.asarray(img.dataobj[..., idx], dtype=np.float32)
+
+
+def stream_correct(volumes, b0, origin, spacing, direction, table, mask_ants,
+                   transform="rigid+syn", warm_start=True, shrink_factor=4):
+    """
+    Push each volume through registration to the b0, y-axis unwarping and
+    division by a shared N4 bias field.
+
+    The b0 (index 0) is not registered; its unwarped version is used to
+    estimate the bias field applied to every volume, as in
+    dwi_biascorrection's shared mode.
+
+    Parameters:
+    - volumes: iterable of (index, 3D array), starting with the b0.
+    - b0: 3D numpy array of the b0.
+    - origin, spacing, direction: 3D ANTs geometry of the volumes.
+    - table: y-interpolation table (see yaxis_warp.y_interpolation_table).
+    - mask_ants: ANTsImage of the brain mask used for the bias field.
+    - transform: str, one of dwi_motioncorrection.TRANSFORMS.
+    - warm_start: bool, initialise each volume from its predecessor's transform.
+    - shrink_factor: int, N4 shrink factor.
+
+    Yields:
+    - (index, corrected float32 volume, motion parameters).
+    """
+    b0_ants = ants.from_numpy(b0, origin=origin, spacing=spacing)
+    reg_mask = ants.get_mask(b0_ants)
+    field = None
+    previous = None
+    for idx, vol in volumes:
+        if idx == 0:
+            params = [0.0] * len(MOTION_COLUMNS)
+        else:
+            vol, linear_transform = register_volume_to_b0(
+                b0_ants, vol, origin, spacing, transform,
+                mask=reg_mask, initial_transform=previous if warm_start else None,
+            )
+            previous = linear_transform
+            params = motion_parameters(linear_transform)
+        vol = apply_y_table(vol, table)
+        if field is None:
+            field = bias_field_of_volume(vol, spacing, origin, direction, mask_ants, shrink_factor)
+        np.divide(vol, field, out=vol, where=field > 0)
+        vol[field <= 0] = 0
+        yield idx, vol, params
+
+
+def run_stream_correction(dwi_path, warp_path, mask_path, transform="rigid+syn", warm_start=True,
+                          jacobian=False, shrink_factor=4, motion_tsv="motion_parameters.tsv"):
+    """
+    Streaming equivalent of DwiMotionCorrection -> DwiApplyTopup ->
+    DwiBiasCorrection (shared mode).
+
+    Volumes are read one at a time from the denoised file and written into a
+    preallocated on-disk float32 array, so the working set is a few volumes
+    instead of several full 4D copies.
+
+    Parameters:
+    - dwi_path: path to the denoised 4D DWI (b0 first).
+    - warp_path: path to the y-axis displacement field from topup.
+    - mask_path: path to the brain mask used for the bias field.
+    - transform: str, one of dwi_motioncorrection.TRANSFORMS.
+    - warm_start: bool, initialise each volume from its predecessor's transform.
+    - jacobian: bool, modulate intensities by the Jacobian of the warp.
+    - shrink_factor: int, N4 shrink factor.
+    - motion_tsv: str or None, path of the per-volume rigid motion parameters.
+
+    Returns:
+    - out_path: path to the corrected image.
+    """
+    img = nib.load(dwi_path, keep_file_open=True)
+    header = ants.image_header_info(dwi_path)
+    origin = tuple(header["origin"][:3])
+    spacing = tuple(header["spacing"][:3])
+    direction = np.asarray(header["direction"])[:3, :3]
+
+    warp_field = nib.load(warp_path).get_fdata(dtype=np.float32)
+    # Ensure the warpfield has the same dimensions as the image
+    warp_field = warp_field[:, : img.shape[1], :]
+    table = y_interpolation_table(warp_field, mode="constant", jacobian=jacobian)
+    del warp_field
+    mask_ants = ants.image_read(mask_path)
+
+    volumes = iter_volumes(img)
+    _, b0 = next(volumes)
+
+    def with_b0():
+        yield 0, b0
+        yield from volumes
+
+    tmp = tempfile.NamedTemporaryFile(dir=".", suffix=".dat", delete=False)
+    tmp.close()
+    try:
+        # Fortran order keeps each volume contiguous on disk, as in NIfTI.
+        out = np.memmap(tmp.name, dtype=np.float32, mode="w+", shape=img.shape, order="F")
+        motion = [[0.0] * len(MOTION_COLUMNS) for _ in range(img.shape[-1])]
+        for idx, vol, params in tqdm(
+            stream_correct(with_b0(), b0, origin, spacing, direction, table, mask_ants,
+                           transform, warm_start, shrink_factor),
+            total=img.shape[-1], desc="Correcting volumes",
+        ):
+            out[..., idx] = vol
+            motion[idx] = params
+        out.flush()
+
+        out_path = "denoised_moving_corrected.nii.gz"
+        nib.save(nib.Nifti1Image(out, img.affine), out_path)
+        del out
+    finally:
+        os.unlink(tmp.name)
+    if motion_tsv:
+        write_motion_tsv(motion, motion_tsv)
+    return out_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Motion-correct, unwarp and bias-correct a denoised DWI one volume at a time."
+    )
+    parser.add_argument("--denoised", type=str, required=True,
+                        help="Path to the denoised DWI (NIfTI file).")
+    parser.add_argument("--warp", type=str, required=True,
+                        help="Path to the y-axis warp field from topup (NIfTI file).")
+    parser.add_argument("--mask", type=str, required=True,
+                        help="Path to the mask image used for the bias field (NIfTI file).")
+    parser.add_argument("--transform", type=str, choices=list(TRANSFORMS), default="rigid+syn",
+                        help="Transform model per volume (default: rigid+syn).")
+    parser.add_argument("--no_warm_start", action="store_true",
+                        help="Do not initialise each volume from its neighbour's transform.")
+    parser.add_argument("--jacobian", action="store_true",
+                        help="Modulate intensities by the Jacobian of the warp.")
+    parser.add_argument("--shrink_factor", type=int, default=4,
+                        help="N4 shrink factor (default: 4).")
+    parser.add_argument("--motion_tsv", type=str, default="motion_parameters.tsv",
+                        help="Output path for the per-volume motion parameters.")
+
+    args = parser.parse_args()
+    out_path = run_stream_correction(args.denoised, args.warp, args.mask,
+                                     transform=args.transform,
+                                     warm_start=not args.no_warm_start,
+                                     jacobian=args.jacobian,
+                                     shrink_factor=args.shrink_factor,
+                                     motion_tsv=args.motion_tsv)
+    print("Corrected image saved as:", out_path)
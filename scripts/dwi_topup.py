@@ -1,9 +1,20 @@
 import argparse
-from topup_new import topup  # assuming topup is available from topup_new.py
+from topup_new import MODES, topup  # assuming topup is available from topup_new.py
+from syn_schedule import PRESETS
+from dwi_index import read_sidecar
 
-def run_topup(moving, b0, b0_bval, b0_bvec):
+def sidecar_pe_axis(nifti_path, default=1):
+    """
+    Voxel axis (0, 1 or 2) of the BIDS PhaseEncodingDirection in the JSON
+    sidecar of nifti_path ("i", "j", "k", optionally with "-"), or default
+    when the sidecar or the field is missing.
+    """
+    pe = read_sidecar(nifti_path).get("PhaseEncodingDirection", "")
+    return "ijk".index(pe[0]) if pe[:1] in ("i", "j", "k") else default
+
+def run_topup(moving, b0, b0_bval, b0_bvec, schedule=None, mode="full", pe_axis=1):
     # topup returns a nonlinear warp and a mask
-    warp, mask = topup(moving, b0, b0_bval, b0_bvec)
+    warp, mask = topup(moving, b0, b0_bval, b0_bvec, schedule=schedule, mode=mode, pe_axis=pe_axis)
     return warp, mask
 
 if __name__ == "__main__":
@@ -22,9 +33,21 @@ if __name__ == "__main__":
                         help="Output path for the warp field (NIfTI file).")
     parser.add_argument("--mask_out", type=str, default="mask.nii.gz",
                         help="Output path for the mask (NIfTI file).")
+    parser.add_argument("--schedule", type=str, choices=sorted(PRESETS), default=None,
+                        help="SyN iteration schedule; levels also stop early on energy plateaus "
+                             "(default: 'default' for --mode full, 'fast' for --mode fast).")
+    parser.add_argument("--mode", type=str, choices=sorted(MODES), default="full",
+                        help="'fast' estimates a phase-encode-only field on a 2x downsampled, "
+                             "Gaussian-smoothed grid and upsamples it.")
+    parser.add_argument("--pe_axis", type=int, choices=(0, 1, 2), default=None,
+                        help="Voxel axis of the phase encoding, the only axis the field may move along "
+                             "with --mode fast (default: from the PhaseEncodingDirection of the --moving "
+                             "JSON sidecar, else 1).")
     args = parser.parse_args()
+    pe_axis = sidecar_pe_axis(args.moving) if args.pe_axis is None else args.pe_axis
     
-    warp, mask = run_topup(args.moving, args.b0, args.b0_bval, args.b0_bvec)
+    warp, mask = run_topup(args.moving, args.b0, args.b0_bval, args.b0_bvec, args.schedule, args.mode,
+                           pe_axis)
     
     # Try saving outputs assuming they are nibabel image objects
     import nibabel as nib
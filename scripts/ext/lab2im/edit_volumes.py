@@ -74,7 +74,10 @@ License.
 import os
 import csv
 import shutil
+import multiprocessing
 import numpy as np
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import tensorflow as tf
 import keras.layers as KL
 from keras.models import Model
@@ -968,23 +971,26 @@ def compute_hard_volumes(labels, voxel_volume=1., label_list=None, skip_backgrou
     :return: numpy 1d vector with the volumes of each structure
     """
 
+    # count all label values in a single pass
+    labels = np.asarray(labels)
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.rint(labels)
+    labels = labels.astype('int64').ravel()
+    lowest = int(labels.min())
+    counts = np.bincount(labels - lowest)
+
     # initialisation
-    subject_label_list = utils.reformat_to_list(np.unique(labels), dtype='int')
     if label_list is None:
-        label_list = subject_label_list
+        label_list = np.flatnonzero(counts) + lowest
     else:
-        label_list = utils.reformat_to_list(label_list)
+        label_list = np.array(utils.reformat_to_list(label_list), dtype='int64')
     if skip_background:
         label_list = label_list[1:]
-    volumes = np.zeros(len(label_list))
 
-    # loop over label values
-    for idx, label in enumerate(label_list):
-        if label in subject_label_list:
-            mask = (labels == label) * 1
-            volumes[idx] = np.sum(mask)
-        else:
-            volumes[idx] = 0
+    # look up the counts of the required labels (labels absent from the label map have a volume of 0)
+    volumes = np.zeros(len(label_list))
+    present = (label_list >= lowest) & (label_list < lowest + len(counts))
+    volumes[present] = counts[label_list[present] - lowest]
 
     return volumes * voxel_volume
 
@@ -2264,13 +2270,22 @@ def upsample_labels_in_dir(labels_dir,
             utils.save_volume(label_list[labels], aff, h, path_result, dtype='int32')
 
 
+def _compute_hard_volumes_of_file(path_label, voxel_volume, label_list, skip_background):
+    """Hard volumes of a single label map file, used by compute_hard_volumes_in_dir."""
+    labels, _, _, _, _, _, subject_res = utils.get_volume_info(path_label, return_volume=True)
+    if voxel_volume is None:
+        voxel_volume = float(np.prod(subject_res))
+    return compute_hard_volumes(labels, voxel_volume, label_list, skip_background)
+
+
 def compute_hard_volumes_in_dir(labels_dir,
                                 voxel_volume=None,
                                 path_label_list=None,
                                 skip_background=True,
                                 path_numpy_result=None,
                                 path_csv_result=None,
-                                FS_sort=False):
+                                FS_sort=False,
+                                n_workers=1):
     """Compute hard volumes of structures for all label maps in a folder.
     :param labels_dir: path of directory with input label maps
     :param voxel_volume: (optional) volume of the voxels. If None, it will be directly inferred from the file header.
@@ -2283,6 +2298,9 @@ def compute_hard_volumes_in_dir(labels_dir,
     :param path_numpy_result: (optional) path where to write the result volumes as a numpy array.
     :param path_csv_result: (optional) path where to write the results as csv file.
     :param FS_sort: (optional) whether to sort the labels in FreeSurfer order.
+    :param n_workers: (optional) number of processes over which label maps are distributed. Default is 1, where label
+    maps are processed one after the other. Use None for all available cores. Results are written in the order of the
+    label maps.
     :return: numpy array with the volume of each structure for all subjects.
     Rows represent label values, and columns represent subjects.
     """
@@ -2296,42 +2314,43 @@ def compute_hard_volumes_in_dir(labels_dir,
     # load or compute labels list
     label_list, _ = utils.get_list_labels(path_label_list, labels_dir, FS_sort=FS_sort)
 
-    # create csv volume file if necessary
-    if path_csv_result is not None:
-        if skip_background:
-            cvs_header = [['subject'] + [str(lab) for lab in label_list[1:]]]
-        else:
-            cvs_header = [['subject'] + [str(lab) for lab in label_list]]
-        with open(path_csv_result, 'w') as csvFile:
-            writer = csv.writer(csvFile)
-            writer.writerows(cvs_header)
-        csvFile.close()
-
     # loop over label maps
     path_labels = utils.list_images_in_folder(labels_dir)
     if skip_background:
         volumes = np.zeros((label_list.shape[0] - 1, len(path_labels)))
     else:
         volumes = np.zeros((label_list.shape[0], len(path_labels)))
-    loop_info = utils.LoopInfo(len(path_labels), 10, 'processing', True)
-    for idx, path_label in enumerate(path_labels):
-        loop_info.update(idx)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    n_workers = max(1, min(n_workers, len(path_labels)))
+    compute_volumes = partial(_compute_hard_volumes_of_file, voxel_volume=voxel_volume, label_list=label_list,
+                              skip_background=skip_background)
+
+    # create csv volume file if necessary, which stays open to write rows in the order of the label maps
+    csv_file = open(path_csv_result, 'w') if path_csv_result is not None else None
+    if csv_file is not None:
+        writer = csv.writer(csv_file)
+        if skip_background:
+            writer.writerow(['subject'] + [str(lab) for lab in label_list[1:]])
+        else:
+            writer.writerow(['subject'] + [str(lab) for lab in label_list])
 
-        # load segmentation, and compute unique labels
-        labels, _, _, _, _, _, subject_res = utils.get_volume_info(path_label, return_volume=True)
-        if voxel_volume is None:
-            voxel_volume = float(np.prod(subject_res))
-        subject_volumes = compute_hard_volumes(labels, voxel_volume, label_list, skip_background)
-        volumes[:, idx] = subject_volumes
-
-        # write volumes
-        if path_csv_result is not None:
-            subject_volumes = np.around(volumes[:, idx], 3)
-            row = [utils.strip_suffix(os.path.basename(path_label))] + [str(vol) for vol in subject_volumes]
-            with open(path_csv_result, 'a') as csvFile:
-                writer = csv.writer(csvFile)
-                writer.writerow(row)
-            csvFile.close()
+    loop_info = utils.LoopInfo(len(path_labels), 10, 'processing', True)
+    executor = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) if n_workers > 1 else None
+    try:
+        results = executor.map(compute_volumes, path_labels) if executor is not None else map(compute_volumes, path_labels)
+        for idx, (path_label, subject_volumes) in enumerate(zip(path_labels, results)):
+            loop_info.update(idx)
+            volumes[:, idx] = subject_volumes
+
+            # write volumes
+            if csv_file is not None:
+                subject_volumes = np.around(volumes[:, idx], 3)
+                writer.writerow([utils.strip_suffix(os.path.basename(path_label))] + [str(v) for v in subject_volumes])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if csv_file is not None:
+            csv_file.close()
 
     # write numpy array if necessary
     if path_numpy_result is not None:
@@ -1,18 +1,18 @@
-import subprocess
 import argparse
+from brain_extraction import extract_brain_files
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Perform N4 Bias Field Correction")
-    parser.add_argument("--input", "-i", required=True, help="Input image file")
+    parser = argparse.ArgumentParser(description="Perform HD-BET brain extraction")
+    parser.add_argument("--input", "-i", nargs="+", required=True, help="Input image file(s)")
     parser.add_argument(
-        "--output", "-o", required=True, help="Output corrected image file"
+        "--output", "-o", nargs="+", required=True, help="Output brain-extracted image file(s), one per input"
     )
-    args = parser.parse_args()
-    subprocess.run(
-        "hd-bet -i "
-        + args.input
-        + " -o "
-        + args.output
-        + " --save_bet_mask",  # + " -device cpu",
-        shell=True,
+    parser.add_argument("--device", default=None, help="cuda, cpu or mps (default: cuda when available)")
+    parser.add_argument(
+        "--disable_tta", action="store_true", help="Disable test-time augmentation (faster, recommended on cpu)"
     )
+    args = parser.parse_args()
+    if len(args.input) != len(args.output):
+        parser.error("--input and --output need the same number of files")
+    # One model load for the whole batch; masks are written as <output>_bet.nii.gz.
+    extract_brain_files(args.input, args.output, device=args.device, use_tta=not args.disable_tta)
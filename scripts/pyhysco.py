@@ -1,6 +1,6 @@
 import numpy as np
 import nibabel as nib
-from scipy.ndimage import map_coordinates
+from yaxis_warp import apply_warpfield_y
 from EPI_MRI.EPIMRIDistortionCorrection import DataObject, EPIMRIDistortionCorrection
 from optimization.ADMM import myAvg1D, myDiff1D, myLaplacian1D, JacobiCG, ADMM
 import torch
@@ -82,40 +82,8 @@ def run(data_image, reverse_image, output_name):
     if fieldmap.shape[1] > im1.shape[1]:
         fieldmap = fieldmap[:, : im1.shape[1], :]
 
-    def apply_warpfield_y(image, warpfield):
-        """
-        Apply a warpfield to an image along the second dimension (y-axis).
-
-        Parameters
-        ----------
-        image : numpy.ndarray
-            The input image to be warped.
-        warpfield : numpy.ndarray
-            The warpfield to apply to the image.
-
-        Returns
-        -------
-        warped_image : numpy.ndarray
-            The warped image.
-        """
-        # Create a grid of coordinates
-        coords = np.meshgrid(
-            np.arange(image.shape[0]),
-            np.arange(image.shape[1]),
-            np.arange(image.shape[2]),
-            indexing="ij",
-        )
-
-        # Apply the warpfield to the coordinates along the second dimension (y-axis)
-        warped_coords = [coords[0], coords[1] + warpfield, coords[2]]
-
-        # Interpolate the image at the warped coordinates
-        warped_image = map_coordinates(image, warped_coords, order=1, mode="nearest")
-
-        return warped_image
-
     # Apply the warpfield to the image along the second dimension
-    warped_im1_y = apply_warpfield_y(im1, fieldmap)
+    warped_im1_y = apply_warpfield_y(im1, fieldmap, mode="nearest")
 
     # Save the warped image
     warped_im1_y_nifti = nib.Nifti1Image(warped_im1_y, affine)
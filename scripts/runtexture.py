@@ -1,22 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from texturepipeline import noelTexturesPy
+from texture_features import FEATURES
 import argparse
 
 
-def run_texture_pipeline(input, mask, output_dir):
+def run_texture_pipeline(input, mask, output_dir, labels=None, label_lut=None, features=None, sigmas=(1.0, 2.0, 4.0)):
     pipeline = noelTexturesPy(
         id='textures',
         output_dir=output_dir,
         input=input,
         mask=mask,
+        labels=labels,
+        label_lut=label_lut,
+        features=features,
+        sigmas=sigmas,
     )
     pipeline.file_processor()
+    return pipeline
+
+
+def run_texture_batch(inputs, mask, output_dirs, labels=None, label_lut=None, features=None,
+                      sigmas=(1.0, 2.0, 4.0), threads=1):
+    """
+    Texture maps of several images on one grid (e.g. T1w and FLAIR in MNI
+    space) in a single process. The mask and GM/WM segmentation are computed
+    once from the first input and shared with the others; the per-input maps
+    of all inputs, the first one included, are then computed concurrently.
+
+    Parameters:
+    - inputs, output_dirs: lists of equal length; outputs use the same
+      naming as run_texture_pipeline.
+    - threads: int, number of inputs processed concurrently.
+    """
+    reference = noelTexturesPy(
+        id='textures',
+        output_dir=output_dirs[0],
+        input=inputs[0],
+        mask=mask,
+        labels=labels,
+        label_lut=label_lut,
+        features=features,
+        sigmas=sigmas,
+    )
+    reference.load_nifti_file()
+    reference.segmentation()
+    pipelines = [reference] + [
+        noelTexturesPy(id='textures', output_dir=output_dir, input=input, mask=mask,
+                       features=features, sigmas=sigmas)
+        for input, output_dir in zip(inputs[1:], output_dirs[1:])
+    ]
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        list(pool.map(lambda pipeline: pipeline.file_processor(reference=reference), pipelines))
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Perform N4 Bias Field Correction")
-    parser.add_argument("--input", "-i", required=True, help="Input image file")
+    parser = argparse.ArgumentParser(description="Compute texture maps (gradient magnitude, relative intensity)")
+    parser.add_argument(
+        "--input", "-i", nargs="+", required=True,
+        help="Input image file(s) on one grid; the first one is segmented"
+    )
     parser.add_argument("--mask", "-m", required=True, help="Input mask file")
     parser.add_argument(
-        "--output", "-o", required=True, help="Output corrected image file"
+        "--output", "-o", nargs="+", required=True, help="Output prefix(es), one per input"
+    )
+    parser.add_argument(
+        "--labels", "-l", default=None,
+        help="Label map in the input space (e.g. warped SynthSeg parcellation); "
+             "GM/WM masks come from it instead of Atropos"
+    )
+    parser.add_argument(
+        "--label-lut", default=None,
+        help="Label -> tissue table ('<label> <GM|WM>' per line); default: SynthSeg labels"
+    )
+    parser.add_argument(
+        "--features", nargs="+", default=None, choices=FEATURES,
+        help="Texture features written together as <output>_features.nii.gz (default: none)"
+    )
+    parser.add_argument(
+        "--sigmas", nargs="+", type=float, default=[1.0, 2.0, 4.0],
+        help="Feature scales in mm (default: 1 2 4)"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Inputs processed concurrently once the shared segmentation is done (default: 1)"
     )
     args = parser.parse_args()
-    run_texture_pipeline(args.input, args.mask, args.output)
+    if len(args.input) != len(args.output):
+        parser.error("--input and --output need the same number of files")
+    run_texture_batch(
+        args.input, args.mask, args.output, args.labels, args.label_lut, args.features, args.sigmas, args.threads
+    )
@@ -0,0 +1,90 @@
+import numpy as np
+from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
+
+# level_iters are the per-level caps (coarsest first); a level also stops as
+# soon as the CC energy improves by less than rel_tol over `window` iterations.
+PRESETS = {
+    "fast": {"level_iters": [200, 50, 10], "rel_tol": 1e-3, "window": 5},
+    "default": {"level_iters": [1000, 100, 10], "rel_tol": 1e-4, "window": 10},
+    "accurate": {"level_iters": [1000, 200, 50], "rel_tol": 1e-5, "window": 20},
+}
+
+
+class AdaptiveSymmetricDiffeomorphicRegistration(SymmetricDiffeomorphicRegistration):
+    """
+    SymmetricDiffeomorphicRegistration that ends each pyramid level on a
+    plateau of the metric energy instead of always running the full budget.
+
+    dipy leaves a level when the value returned by ``_iterate`` drops below
+    ``opt_tol``; returning -inf on a plateau reuses that exit. The number of
+    iterations actually run per level is kept in ``iterations_used``.
+
+    With ``constrain_axis`` set, displacement components along every other
+    axis are zeroed after each iteration, so the deformation only acts along
+    that axis (e.g. the phase-encode direction for susceptibility fields).
+    Components follow the world axes of the registration grid, which are the
+    voxel axes when no grid2world affines are given.
+    """
+
+    def __init__(self, metric, level_iters, rel_tol=1e-4, window=10, constrain_axis=None, **kwargs):
+        super().__init__(metric, level_iters=level_iters, **kwargs)
+        self.rel_tol = rel_tol
+        self.window = window
+        self.constrain_axis = constrain_axis
+        self.iterations_used = {}
+
+    def _plateaued(self):
+        energy = self.energy_list
+        if len(energy) <= self.window:
+            return False
+        old, new = energy[-self.window - 1], energy[-1]
+        return abs(old - new) <= self.rel_tol * max(abs(old), 1e-12)
+
+    def _constrain(self):
+        others = [axis for axis in range(self.dim) if axis != self.constrain_axis]
+        for dmap in (self.static_to_ref, self.moving_to_ref):
+            dmap.forward[..., others] = 0
+            dmap.backward[..., others] = 0
+
+    def _iterate(self):
+        der = super()._iterate()
+        if self.constrain_axis is not None:
+            self._constrain()
+        self.iterations_used[self.current_level] = len(self.energy_list)
+        if self._plateaued():
+            return -np.inf
+        return der
+
+    def optimize(self, *args, **kwargs):
+        self.iterations_used = {}
+        mapping = super().optimize(*args, **kwargs)
+        for level in range(self.levels - 1, -1, -1):
+            cap = self.level_iters[self.levels - 1 - level]
+            used = self.iterations_used.get(level, 0)
+            print(f"SyN level {level}: {used}/{cap} iterations")
+        return mapping
+
+
+def make_sdr(metric, schedule="default", **kwargs):
+    """
+    Build an adaptive SyN optimizer from one of the PRESETS.
+
+    Parameters:
+    - metric: dipy similarity metric (e.g. CCMetric(3)).
+    - schedule: str, one of PRESETS.
+    - kwargs: forwarded to AdaptiveSymmetricDiffeomorphicRegistration
+      (e.g. constrain_axis) and SymmetricDiffeomorphicRegistration.
+
+    Returns:
+    - sdr: AdaptiveSymmetricDiffeomorphicRegistration.
+    """
+    if schedule not in PRESETS:
+        raise ValueError(f"Unknown schedule '{schedule}', expected one of {sorted(PRESETS)}")
+    preset = PRESETS[schedule]
+    return AdaptiveSymmetricDiffeomorphicRegistration(
+        metric,
+        list(preset["level_iters"]),
+        rel_tol=preset["rel_tol"],
+        window=preset["window"],
+        **kwargs,
+    )
@@ -19,6 +19,9 @@ def main():
     b0_bval_path = "/home/ian/GitHub/testdata/sub-HC131_ses-01_dir-PA_dwi.bval"
     b0_bvec_path = "/home/ian/GitHub/testdata/sub-HC131_ses-01_dir-PA_dwi.bvec"
     atlas_path = "mni_icbm152_t2_tal_nlin_sym_09a.nii"
+    # Shared atlas cache directory for the registration steps; None disables it
+    atlas_cache = None
+    atlas_cache_args = ["--atlas_cache", atlas_cache] if atlas_cache else []
 
     # Define expected output filenames
     mask_path = "mask.nii.gz"
@@ -88,7 +91,7 @@ def main():
         "--bval", dwi_bval_path,
         "--bvec", dwi_bvec_path,
         "--atlas", atlas_path
-    ], check=True)
+    ] + atlas_cache_args, check=True)
 
     # Step 7: Nonlinear Registration
     print("Running dwi_nonlinearreg.py ...")
@@ -96,7 +99,7 @@ def main():
         sys.executable, "dwi_nonlinearreg.py",
         "--atlas", atlas_path,
         "--fixed", linear_reg_output
-    ], check=True)
+    ] + atlas_cache_args, check=True)
 
     # Step 8: Compute FA and MD maps
     print("Running dwi_compute_fa_md.py ...")
@@ -1,7 +1,6 @@
 import os
 import random
 import string
-from collections import Counter
 
 import ants
 import numpy as np
@@ -13,30 +12,74 @@ def write_nifti(input, id, output_dir, type):
 
 
 def compute_RI(image, bg, mask):
-    ri = np.zeros_like(image)
-    bgm = np.stack(np.where(np.logical_and(image < bg, mask == 1)), axis=1)
-    bgm_ind = bgm[:, 0], bgm[:, 1], bgm[:, 2]
-    bgp = np.stack(np.where(np.logical_and(image > bg, mask == 1)), axis=1)
-    bgp_ind = bgp[:, 0], bgp[:, 1], bgp[:, 2]
+    """Relative intensity in percent of bg inside the mask (0 elsewhere), float32."""
+    image = np.asarray(image, dtype=np.float32)
+    bg = np.float32(bg)
+    inside = (mask == 1) & (image != bg)
+    return np.where(inside, 100 * (1 - np.abs(image - bg) / bg), 0).astype(np.float32)
 
-    ri[bgm_ind] = 100 * (1 - (bg - image[bgm_ind]) / bg)
-    ri[bgp_ind] = 100 * (1 + (bg - image[bgp_ind]) / bg)
-    return ri
+
+def intensity_mode(x):
+    """Most frequent value of the rounded intensities, via a bincount."""
+    x = np.rint(x).astype(np.int64)
+    offset = x.min()
+    return float(np.argmax(np.bincount(x - offset)) + offset)
 
 
 def peakfinder(gm, wm, lower_q, upper_q):
-    gm_peak = Counter(threshold_percentile(gm, lower_q, upper_q)).most_common(1)[0][0]
-    wm_peak = Counter(threshold_percentile(wm, lower_q, upper_q)).most_common(1)[0][0]
+    """
+    Midpoint between the GM and WM intensity modes.
+
+    Parameters:
+    - gm, wm: 1D arrays of the image intensities inside the GM and WM masks.
+    - lower_q, upper_q: percentiles bounding the values used for each mode.
+    """
+    gm_peak = intensity_mode(threshold_percentile(gm, lower_q, upper_q))
+    wm_peak = intensity_mode(threshold_percentile(wm, lower_q, upper_q))
     bg = 0.5 * (gm_peak + wm_peak)
     return bg
 
 
 def threshold_percentile(x, lower_q, upper_q):
-    x = x.numpy()
-    lq = np.percentile(x, lower_q)
-    uq = np.percentile(x, upper_q)
-    x = x[np.logical_and(x > lq, x <= uq)]
-    return x.flatten().round()
+    lq, uq = np.percentile(x, (lower_q, upper_q))
+    return x[(x > lq) & (x <= uq)]
+
+
+# Default GM/WM mapping of SynthSeg (FreeSurfer) labels, including the
+# cortical parcels written with --parc.
+SYNTHSEG_TISSUE_LUT = {
+    'GM': [3, 42, 8, 47, 10, 11, 12, 13, 17, 18, 26, 28, 49, 50, 51, 52, 53, 54, 60]
+    + list(range(1000, 1036)) + list(range(2000, 2036)),
+    'WM': [2, 41, 7, 46],
+}
+
+
+def load_label_lut(path=None):
+    """Read a label -> tissue table ("<label> <GM|WM>" per line, '#' comments)."""
+    if path is None:
+        return SYNTHSEG_TISSUE_LUT
+    lut = {'GM': [], 'WM': []}
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if len(fields) < 2:
+                continue
+            tissue = fields[1].upper()
+            if tissue in lut:
+                lut[tissue].append(int(fields[0]))
+    return lut
+
+
+def tissue_masks(labels, lut):
+    """GM and WM float32 masks of an integer label array through a lookup table."""
+    labels = np.asarray(labels).astype(np.int64)
+    max_label = max(max(lut['GM'], default=0), max(lut['WM'], default=0))
+    table = np.zeros(max_label + 2, dtype=np.uint8)
+    table[lut['GM']] = 1
+    table[lut['WM']] = 2
+    # labels outside the table (or negative) map to the trailing 0 entry
+    tissue = table[np.where((labels >= 0) & (labels <= max_label), labels, max_label + 1)]
+    return (tissue == 1).astype('float32'), (tissue == 2).astype('float32')
 
 
 def find_logger_basefilename(logger):
@@ -64,6 +107,7 @@ import time
 
 import ants  # type: ignore[import-untyped]
 import numpy as np
+from texture_features import texture_bank, write_feature_bank
 
 # import zipfile
 from PIL import Image
@@ -83,21 +127,43 @@ class noelTexturesPy:
         output_dir=None,
         input=None,
         mask=None,
+        labels=None,
+        label_lut=None,
+        features=None,
+        sigmas=(1.0, 2.0, 4.0),
     ):
         super().__init__()
         self._id = id
         self._outputdir = output_dir
         self.input = input
         self.mask = mask
+        self.labels = labels
+        self.label_lut = label_lut
+        self.features = features
+        self.sigmas = sigmas
 
     def load_nifti_file(self):
         # load nifti data to memory
         print('loading nifti files')
         self._input = ants.image_read(self.input)
         self._mask = ants.image_read(self.mask)
+        self._input_np = self._input.numpy()
+        self._mask_np = self._mask.numpy()
+
+    def share_segmentation(self, reference):
+        # reuse the mask and GM/WM masks of a pipeline on the same grid
+        # (e.g. T1w for FLAIR), so only the input is read
+        print('loading nifti files (shared mask and segmentation)')
+        self._input = ants.image_read(self.input)
+        self._input_np = self._input.numpy()
+        self._mask, self._mask_np = reference._mask, reference._mask_np
+        self._gm, self._wm = reference._gm, reference._wm
 
 
     def segmentation(self):
+        if self.labels is not None:
+            self.label_segmentation()
+            return
         print('computing GM, WM, CSF segmentation')
         # https://antsx.github.io/ANTsPyNet/docs/build/html/utilities.html#applications
 
@@ -110,8 +176,21 @@ class noelTexturesPy:
             x=self._mask,
         )
         self._segm = segm['segmentation']
-        self._gm = np.where((self._segm.numpy() == 2), 1, 0).astype('float32')
-        self._wm = np.where((self._segm.numpy() == 3), 1, 0).astype('float32')
+        segm = self._segm.numpy()
+        self._gm = (segm == 2).astype('float32')
+        self._wm = (segm == 3).astype('float32')
+
+    def label_segmentation(self):
+        print('deriving GM, WM masks from label map')
+        # labels must be warped to the input space already; a nearest-label
+        # resampling only absorbs grid differences
+        labels = ants.image_read(self.labels)
+        if labels.shape != self._input.shape:
+            labels = ants.resample_image_to_target(labels, self._input, interp_type='genericLabel')
+        gm, wm = tissue_masks(labels.numpy(), load_label_lut(self.label_lut))
+        inside = self._mask_np > 0
+        self._gm = gm * inside
+        self._wm = wm * inside
 
 
     def gradient_magnitude(self):
@@ -128,10 +207,8 @@ class noelTexturesPy:
     def relative_intensity(self):
         print('computing relative intensity')
 
-        input_n4_gm = self._input * self._input.new_image_like(self._gm)
-        input_n4_wm = self._input * self._input.new_image_like(self._wm)
-        bg_input = peakfinder(input_n4_gm, input_n4_wm, 1, 99.5)
-        input_ri = compute_RI(self._input.numpy(), bg_input, self._mask.numpy())
+        bg_input = peakfinder(self._input_np[self._gm > 0], self._input_np[self._wm > 0], 1, 99.5)
+        input_ri = compute_RI(self._input_np, bg_input, self._mask_np)
         tmp = self._input.new_image_like(input_ri)
         self._ri = ants.smooth_image(tmp, sigma=3, FWHM=True)
         ants.image_write(
@@ -140,12 +217,27 @@ class noelTexturesPy:
         )
 
 
-    def file_processor(self):
+    def texture_features(self):
+        print('computing texture feature bank')
+
+        names, bank = texture_bank(
+            self._input_np, self._mask_np, self._input.spacing, self.features, self.sigmas
+        )
+        write_feature_bank(bank, names, self.input, self._outputdir + '_features.nii.gz')
+
+
+    def file_processor(self, reference=None):
         start = time.time()
-        self.load_nifti_file()
-        self.segmentation()
+        if reference is None:
+            self.load_nifti_file()
+            self.segmentation()
+        elif reference is not self:
+            # a pipeline passed as its own reference is already loaded and segmented
+            self.share_segmentation(reference)
         self.gradient_magnitude()
         self.relative_intensity()
+        if self.features:
+            self.texture_features()
         # self.create_zip_archive()
         end = time.time()
         print(
@@ -5,31 +5,120 @@ from dipy.denoise.noise_estimate import estimate_sigma
 from dipy.core.gradients import gradient_table
 import copy
 import numpy as np
-import subprocess
-from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
 from dipy.align.metrics import CCMetric  # cross-correlation metric
+from dipy.align.imwarp import DiffeomorphicMap
 from nibabel.processing import resample_from_to
-def topup(moving_dwi_img,b0_image, down_bval, down_bvec):
+from scipy.ndimage import gaussian_filter, map_coordinates
+from syn_schedule import make_sdr
+from brain_extraction import extract_brains
+
+# Registration settings of the two estimation modes. "fast" works on a grid
+# downsampled by `factor`, smooths with a Gaussian instead of nlmeans, runs
+# fewer affine iterations and lets SyN deform along the phase-encode axis only.
+MODES = {
+    "full": {"factor": 1, "denoiser": "nlmeans", "schedule": "default", "constrain": False,
+             "level_iters": [500, 100, 50], "sigmas": [4.0, 2.0, 1.0], "factors": [8, 4, 2]},
+    "fast": {"factor": 2, "denoiser": "gaussian", "schedule": "fast", "constrain": True,
+             "level_iters": [100, 20], "sigmas": [2.0, 1.0], "factors": [4, 2]},
+}
+
+
+def denoise(data, method):
+    """
+    Denoise a 3D volume or the volumes of a 4D image.
+
+    Parameters:
+    - data: 3D or 4D numpy array.
+    - method: "nlmeans", "gaussian" (sigma of one voxel) or None.
+    """
+    if method == "nlmeans":
+        return nlmeans(data, estimate_sigma(data))
+    if method == "gaussian":
+        return gaussian_filter(data, sigma=(1, 1, 1, 0)[:data.ndim])
+    return data
+
+
+def downsample(data, affine, factor):
+    """
+    Block-average the three spatial axes by an integer factor.
+
+    Returns:
+    - coarse: float32 array.
+    - coarse_affine: voxel-to-world affine of the coarse grid.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if factor == 1:
+        return data, affine
+    shape = [n // factor for n in data.shape[:3]]
+    data = data[:shape[0] * factor, :shape[1] * factor, :shape[2] * factor]
+    blocks = data.reshape(shape[0], factor, shape[1], factor, shape[2], factor, *data.shape[3:])
+    coarse = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    scale = np.diag([factor, factor, factor, 1.0])
+    scale[:3, 3] = (factor - 1) / 2
+    return coarse, affine @ scale
+
+
+def upsample(volume, factor, shape, order=1):
+    """
+    Resample a coarse array from downsample back to the full grid `shape`.
+    """
+    coords = np.meshgrid(*[(np.arange(n) - (factor - 1) / 2) / factor for n in shape], indexing="ij")
+    return map_coordinates(volume, coords, order=order, mode="nearest")
+
+
+def upsample_mapping(mapping, factor, shape):
+    """
+    Full-resolution DiffeomorphicMap from a mapping estimated on the coarse
+    grid. Displacements are in voxel units, so they are scaled by factor.
+    """
+    full = DiffeomorphicMap(3, shape, domain_shape=shape, codomain_shape=shape)
+    for name in ("forward", "backward"):
+        coarse = getattr(mapping, name)
+        field = np.empty(tuple(shape) + (3,), dtype=np.float32)
+        for c in range(3):
+            field[..., c] = upsample(coarse[..., c], factor, shape) * factor
+        setattr(full, name, field)
+    return full
+
+
+def topup(moving_dwi_img,b0_image, down_bval, down_bvec, schedule=None, mode="full", pe_axis=1):
+    """
+    Estimate the susceptibility field between the b0 of the DWI and the
+    reverse phase-encoded b0.
+
+    Parameters:
+    - moving_dwi_img, b0_image: paths of the DWI and reverse-PE b0.
+    - down_bval, down_bvec: gradient table of the reverse-PE image.
+    - schedule: str or None, SyN schedule preset (default: the mode's).
+    - mode: "full" or "fast" (see MODES).
+    - pe_axis: int, voxel axis of the phase encoding, used by "fast".
+
+    Returns:
+    - halfmapping: DiffeomorphicMap with half the estimated displacement.
+    - mask_path: path of the brain mask of the DWI b0.
+    """
+    settings = MODES[mode]
+    factor = settings["factor"]
     moving_map = nib.load(moving_dwi_img)
     fixed_map = nib.load(b0_image)
-    
-    moving_sigma = estimate_sigma(moving_map.get_fdata()[...,0])
-    moving_map_denoised = nlmeans(moving_map.get_fdata()[...,0],moving_sigma)
-    
-    fixed_sigma = estimate_sigma(fixed_map.get_fdata())
-    fixed_map_denoised = nlmeans(fixed_map.get_fdata(),fixed_sigma)
+    full_shape = moving_map.shape[:3]
+
+    moving_b0, moving_affine = downsample(moving_map.dataobj[..., 0], moving_map.affine, factor)
+    fixed_data, fixed_affine = downsample(fixed_map.dataobj, fixed_map.affine, factor)
+    moving_map_denoised = denoise(moving_b0, settings["denoiser"])
+    fixed_map_denoised = denoise(fixed_data, settings["denoiser"])
     
     
     pipeline = ["center_of_mass", "translation","rigid", "affine"]
-    level_iters = [500, 100, 50]    # Adjusted parameters
-    sigmas = [4.0, 2.0, 1.0]
-    factors = [8, 4, 2]
+    level_iters = settings["level_iters"]
+    sigmas = settings["sigmas"]
+    factors = settings["factors"]
     xformed_dwi, reg_affine = register_dwi_to_template(
             dwi=fixed_map_denoised,
-            dwi_affine=fixed_map.affine,
+            dwi_affine=fixed_affine,
             gtab=gradient_table(down_bval,down_bvec),
             template=moving_map_denoised,
-            template_affine=moving_map.affine,
+            template_affine=moving_affine,
             reg_method="aff",
             nbins=32,
             metric='MI',
@@ -38,39 +127,39 @@ def topup(moving_dwi_img,b0_image, down_bval, down_bvec):
             sigmas=sigmas,
             factors=factors)
     
-    fixed_xformed_dwi = nib.Nifti1Image(xformed_dwi, moving_map.affine)
+    fixed_xformed_dwi = nib.Nifti1Image(xformed_dwi, moving_affine)
     nib.save(fixed_xformed_dwi, "topup_registered.nii.gz")
     
     # ----- Use HD-BET to extract brains from both xformed_dwi and upwards_map_denoised -----
-    # Run HD-BET on the registered image
-    subprocess.run("hd-bet -i topup_registered.nii.gz -o topup_registered_extracted.nii.gz --save_bet_mask", shell=True)
-    fixed_xformed_dwi_brain = nib.load("topup_registered_extracted.nii.gz")
-    
-    # Save the denoised upwards map as a temporary NIfTI for HD-BET, then run HD-BET
-    upwards_nifti = nib.Nifti1Image(moving_map_denoised, moving_map.affine)
-    nib.save(upwards_nifti, "upwards_map_denoised.nii.gz")
-    subprocess.run("hd-bet -i upwards_map_denoised.nii.gz -o moving_map_denoised_extracted.nii.gz --save_bet_mask", shell=True)
-    moving_map_denoised_brain = nib.load("moving_map_denoised_extracted.nii.gz")
+    # Both images go through one in-process HD-BET model load
+    (_, fixed_xformed_dwi_brain), (moving_mask, moving_map_denoised_brain) = extract_brains([
+        (np.asarray(xformed_dwi, dtype=np.float32), moving_affine),
+        (np.asarray(moving_map_denoised, dtype=np.float32), moving_affine),
+    ])
+    if factor > 1:
+        moving_mask = upsample(moving_mask, factor, full_shape, order=0)
+    nib.save(nib.Nifti1Image(moving_mask, moving_map.affine), "moving_map_denoised_extracted_bet.nii.gz")
     
     
     # First, robustly scale the fixed, denoised up map
-    p1_up, p99_up = np.percentile(moving_map_denoised_brain.get_fdata(), (1, 99))
-    scaled_up = np.clip(moving_map_denoised_brain.get_fdata(), p1_up, p99_up)
+    p1_up, p99_up = np.percentile(moving_map_denoised_brain, (1, 99))
+    scaled_up = np.clip(moving_map_denoised_brain, p1_up, p99_up)
     corrected_moving = (scaled_up - p1_up) / (p99_up - p1_up + 1e-8)
     # Robustly scale the current corrected up image between 0 and 1
-    p1_corr, p99_corr = np.percentile(fixed_xformed_dwi_brain.get_fdata(), (1, 99))
-    scaled_corr = np.clip(fixed_xformed_dwi_brain.get_fdata(), p1_corr, p99_corr)
+    p1_corr, p99_corr = np.percentile(fixed_xformed_dwi_brain, (1, 99))
+    scaled_corr = np.clip(fixed_xformed_dwi_brain, p1_corr, p99_corr)
     corrected_fixed = (scaled_corr - p1_corr) / (p99_corr - p1_corr + 1e-8)
     
     # --- STEP 2: Set Up the Symmetric Diffeomorphic Registration (SDR) ---
     # Choose a metric. Here we use the cross-correlation metric.
     metric = CCMetric(3)  # 3 is the dimension (3D)
-    # Level iterations (you may need to adjust these for your data)
-    level_iters = [1000, 100, 10]
-
-    # Initialize the registration object
-    sdr = SymmetricDiffeomorphicRegistration(metric, level_iters)
+    # Iteration caps per level come from the schedule preset; levels stop
+    # early once the CC energy plateaus.
+    sdr = make_sdr(metric, schedule or settings["schedule"],
+                   constrain_axis=pe_axis if settings["constrain"] else None)
     mapping = sdr.optimize(corrected_fixed,corrected_moving)
+    if factor > 1:
+        mapping = upsample_mapping(mapping, factor, full_shape)
     
     
     half_forward_map = mapping.forward/2
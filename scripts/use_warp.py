@@ -2,9 +2,10 @@ import ants
 import argparse
 
 
-def apply_warp(moving_file, reference_file, affine_file, warp_file, out_file):
+def apply_warp(moving_file, reference_file, affine_file, warp_file, out_file, interpolator="linear"):
     """
     Apply an affine transform and a warp field to a moving image, resampling into the reference image space.
+    Use interpolator="genericLabel" (or "nearestNeighbor") for label maps.
     """
     # Load images and transforms
     moving_img = ants.image_read(moving_file)
@@ -13,7 +14,8 @@ def apply_warp(moving_file, reference_file, affine_file, warp_file, out_file):
     # The order of transforms in transformlist matters (last Transform will be applied first).
     # Usually you put the nonlinear warp first, then the affine:
     transformed = ants.apply_transforms(
-        fixed=reference_img, moving=moving_img, transformlist=[warp_file, affine_file]
+        fixed=reference_img, moving=moving_img, transformlist=[warp_file, affine_file],
+        interpolator=interpolator,
     )
 
     # Save the transformed image
@@ -40,9 +42,13 @@ def main():
     parser.add_argument(
         "--out", default="warped_image.nii.gz", help="Output warped image filename."
     )
+    parser.add_argument(
+        "--interpolator", default="linear",
+        help="ANTs interpolator, e.g. linear, nearestNeighbor or genericLabel for label maps."
+    )
     args = parser.parse_args()
 
-    apply_warp(args.moving, args.reference, args.affine, args.warp, args.out)
+    apply_warp(args.moving, args.reference, args.affine, args.warp, args.out, args.interpolator)
 
 
 if __name__ == "__main__":
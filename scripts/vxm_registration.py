@@ -0,0 +1,124 @@
+import os
+import tempfile
+
+import ants
+import numpy as np
+
+# voxelmorph picks its backend at import time
+os.environ.setdefault("NEURITE_BACKEND", "pytorch")
+os.environ.setdefault("VXM_BACKEND", "pytorch")
+
+
+def pad_to_multiple(data, divisor):
+    """
+    Pad the data symmetrically so that each dimension is a multiple of the given divisor.
+    The padding is centered (i.e. extra pixel is added at the end if the padding is odd).
+
+    Returns the padded array and the slices that crop it back to the input shape.
+    """
+    pad_width = []
+    crop = []
+    for d in data.shape:
+        target = int(np.ceil(d / divisor) * divisor)
+        pad_total = target - d
+        pad_before = pad_total // 2
+        pad_after = pad_total - pad_before
+        pad_width.append((pad_before, pad_after))
+        crop.append(slice(pad_before, pad_before + d))
+    padded = np.pad(data, pad_width, mode="constant", constant_values=0)
+    return padded, tuple(crop)
+
+
+def robust_rescale(data):
+    """
+    Clip to the 1st/99th percentiles and rescale to [0, 1] as float32, which is
+    the intensity range the VoxelMorph brain models were trained on.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    p1, p99 = np.percentile(data, (1, 99))
+    data = np.clip(data, p1, p99)
+    return (data - p1) / (p99 - p1 + 1e-8)
+
+
+def voxel_to_physical_field(flow, reference):
+    """
+    Convert a VoxelMorph flow (3, nx, ny, nz) in voxel units into an ANTs
+    displacement field image in physical (LPS) units on the reference grid.
+    """
+    spacing = np.asarray(reference.spacing, dtype=np.float64)
+    index_to_physical = np.asarray(reference.direction, dtype=np.float64) * spacing[None, :]
+    field = np.einsum("ij,j...->...i", index_to_physical, flow).astype(np.float32)
+    return ants.from_numpy(
+        field,
+        origin=reference.origin,
+        spacing=reference.spacing,
+        direction=reference.direction,
+        has_components=True,
+    )
+
+
+def voxelmorph_registration(fixed, moving, model_file, device="cpu", threads=None, divisor=16):
+    """
+    Affine + VoxelMorph deformable registration of two ANTs images.
+
+    The result mirrors the dictionary returned by ``ants.registration`` for the
+    SyN family, so callers can treat both backends the same way:
+    ``fwdtransforms`` is ``[warp, affine]`` and ``invtransforms`` is
+    ``[affine, inverse_warp]``. Transform files are written to a temporary
+    directory, like ANTs does.
+
+    Parameters:
+    - fixed: ANTsImage, the target image (e.g. the atlas).
+    - moving: ANTsImage, the image to register.
+    - model_file: str, path to a pytorch VxmDense model.
+    - device: str, torch device used for the forward pass.
+    - threads: int or None, number of intra-op threads for the CPU forward pass.
+    - divisor: int, images are padded so each dimension is a multiple of this.
+
+    Returns:
+    - dict with 'warpedmovout', 'fwdtransforms' and 'invtransforms'.
+    """
+    import torch
+    import voxelmorph as vxm
+
+    if threads:
+        torch.set_num_threads(int(threads))
+
+    # Affine pre-alignment; the network only models the residual deformation.
+    affine_reg = ants.registration(fixed=fixed, moving=moving, type_of_transform="Affine")
+    affine_file = affine_reg["fwdtransforms"][0]
+
+    fixed_data, crop = pad_to_multiple(robust_rescale(fixed.numpy()), divisor)
+    moving_data, _ = pad_to_multiple(robust_rescale(affine_reg["warpedmovout"].numpy()), divisor)
+
+    model = vxm.networks.VxmDense.load(model_file, device)
+    model.to(device)
+    model.eval()
+
+    with torch.inference_mode():
+        input_moving = torch.from_numpy(moving_data[None, None]).to(device)
+        input_fixed = torch.from_numpy(fixed_data[None, None]).to(device)
+        _, flow = model(input_moving, input_fixed, registration=True)
+    flow = flow[0].cpu().numpy()[(slice(None),) + crop]
+
+    warp = voxel_to_physical_field(flow, fixed)
+    inverse_warp = ants.invert_displacement_field(
+        warp, voxel_to_physical_field(-flow, fixed)
+    )
+
+    out_dir = tempfile.mkdtemp()
+    warp_file = os.path.join(out_dir, "vxm1Warp.nii.gz")
+    inverse_warp_file = os.path.join(out_dir, "vxm1InverseWarp.nii.gz")
+    ants.image_write(warp, warp_file)
+    ants.image_write(inverse_warp, inverse_warp_file)
+
+    fwdtransforms = [warp_file, affine_file]
+    invtransforms = [affine_file, inverse_warp_file]
+    warpedmovout = ants.apply_transforms(
+        fixed=fixed, moving=moving, transformlist=fwdtransforms
+    )
+    return {
+        "warpedmovout": warpedmovout,
+        "fwdtransforms": fwdtransforms,
+        "invtransforms": invtransforms,
+    }
@@ -0,0 +1,229 @@
+import argparse
+import json
+
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+# A registration is flagged when any of these limits is exceeded.
+DEFAULT_THRESHOLDS = {
+    "max_pct_folding": 0.1,  # % of voxels with det(J) <= 0
+    "min_jacobian": 0.05,
+    "max_ice_p95": 2.0,  # mm
+    "max_displacement": 40.0,  # mm
+}
+
+JACOBIAN_BINS = np.linspace(-1.0, 5.0, 6001)
+ICE_BINS = np.linspace(0.0, 20.0, 2001)
+DISPLACEMENT_BINS = np.linspace(0.0, 50.0, 101)
+PERCENTILES = (1, 5, 50, 95, 99)
+
+
+class DisplacementField:
+    """
+    Lazy view of a displacement field stored as (nx, ny, nz, 3) (dipy) or
+    (nx, ny, nz, 1, 3) (ANTs). Only the requested z-slab is read and returned
+    as float32 RAS displacements in mm.
+
+    ANTs writes its vectors in LPS, dipy in RAS; frame="auto" picks LPS for
+    the 5D ANTs layout.
+    """
+
+    def __init__(self, path, frame="auto"):
+        self.img = nib.load(path)
+        shape = self.img.shape
+        if len(shape) not in (4, 5) or shape[-1] != 3:
+            raise ValueError(f"{path} is not a 3D displacement field (shape {shape})")
+        self.shape = shape[:3]
+        self.affine = self.img.affine
+        if frame == "auto":
+            frame = "lps" if len(shape) == 5 else "ras"
+        self.flip = np.array([-1.0, -1.0, 1.0] if frame == "lps" else [1.0, 1.0, 1.0], dtype=np.float32)
+
+    def slab(self, z0, z1):
+        z0 = min(max(z0, 0), self.shape[2])
+        z1 = max(min(z1, self.shape[2]), z0)
+        if z1 == z0:
+            return np.zeros(self.shape[:2] + (0, 3), dtype=np.float32), z0
+        data = np.asarray(self.img.dataobj[:, :, z0:z1], dtype=np.float32)
+        data = data.reshape(self.shape[0], self.shape[1], z1 - z0, 3)
+        return data * self.flip, z0
+
+
+def _percentiles(hist, edges, total):
+    cdf = np.cumsum(hist) / max(total, 1)
+    return {str(q): float(edges[min(np.searchsorted(cdf, q / 100.0), len(edges) - 1)]) for q in PERCENTILES}
+
+
+def _jacobian_determinant(u, index_to_world_inv):
+    """det(I + du/dx) for a slab of RAS displacements (with a one-slice halo)."""
+    grads = np.stack(np.gradient(u, axis=(0, 1, 2)), axis=-1)  # (..., i, k)
+    jac = np.einsum("...ik,kj->...ij", grads, index_to_world_inv)
+    jac += np.eye(3, dtype=np.float32)
+    return np.linalg.det(jac)
+
+
+def analyse_warp(fwd_path, bak_path=None, mask_path=None, frame="auto", slab=32,
+                 thresholds=DEFAULT_THRESHOLDS):
+    """
+    Compute warp-quality metrics slab by slab so that only a few slices of each
+    field are held in memory at a time.
+
+    Parameters:
+    - fwd_path: str, forward displacement field (NIfTI).
+    - bak_path: str or None, backward field on the same grid; enables the
+      inverse-consistency error (ICE) |u_f(x) + u_b(x + u_f(x))|.
+    - mask_path: str or None, restrict the statistics to this mask.
+    - frame: "auto", "ras" or "lps", vector convention of the fields.
+    - slab: int, number of z-slices processed at a time.
+    - thresholds: dict, limits used to flag the registration.
+
+    Returns:
+    - report: dict with jacobian, ice, displacement statistics and flags.
+    """
+    fwd = DisplacementField(fwd_path, frame)
+    bak = DisplacementField(bak_path, frame) if bak_path else None
+    mask_img = nib.load(mask_path) if mask_path else None
+
+    affine = fwd.affine.astype(np.float64)
+    index_to_world_inv = np.linalg.inv(affine[:3, :3]).astype(np.float32)
+    if bak is not None:
+        # world -> bak voxel index
+        bak_world_to_index = np.linalg.inv(bak.affine)
+
+    nz = fwd.shape[2]
+    n_vox = 0
+    n_fold = 0
+    jac_sum = 0.0
+    jac_min = np.inf
+    jac_max = -np.inf
+    jac_hist = np.zeros(len(JACOBIAN_BINS) - 1, dtype=np.int64)
+    disp_hist = np.zeros(len(DISPLACEMENT_BINS) - 1, dtype=np.int64)
+    disp_max = 0.0
+    disp_sum = 0.0
+    ice_hist = np.zeros(len(ICE_BINS) - 1, dtype=np.int64)
+    ice_sum = 0.0
+    ice_max = 0.0
+    n_ice = 0
+
+    for z0 in range(0, nz, slab):
+        z1 = min(z0 + slab, nz)
+        # one-slice halo so the z-gradient is central inside the slab
+        u_halo, h0 = fwd.slab(z0 - 1, z1 + 1)
+        det = _jacobian_determinant(u_halo, index_to_world_inv)[:, :, z0 - h0:z1 - h0]
+        u = u_halo[:, :, z0 - h0:z1 - h0]
+        del u_halo
+
+        if mask_img is not None:
+            inside = np.asarray(mask_img.dataobj[:, :, z0:z1]) > 0
+        else:
+            inside = np.ones(det.shape, dtype=bool)
+        if not inside.any():
+            continue
+
+        d = det[inside]
+        n_vox += d.size
+        n_fold += int(np.count_nonzero(d <= 0))
+        jac_sum += float(d.sum(dtype=np.float64))
+        jac_min = min(jac_min, float(d.min()))
+        jac_max = max(jac_max, float(d.max()))
+        jac_hist += np.histogram(np.clip(d, JACOBIAN_BINS[0], JACOBIAN_BINS[-1]), JACOBIAN_BINS)[0]
+
+        mag = np.linalg.norm(u[inside], axis=-1)
+        disp_sum += float(mag.sum(dtype=np.float64))
+        disp_max = max(disp_max, float(mag.max()))
+        disp_hist += np.histogram(np.clip(mag, 0, DISPLACEMENT_BINS[-1]), DISPLACEMENT_BINS)[0]
+
+        if bak is not None:
+            idx = np.stack(np.nonzero(inside), axis=-1).astype(np.float64)
+            idx[:, 2] += z0
+            world = idx @ affine[:3, :3].T + affine[:3, 3] + u[inside]
+            target = world @ bak_world_to_index[:3, :3].T + bak_world_to_index[:3, 3]
+            # read only the backward slices the forward field points into
+            b0 = int(np.floor(target[:, 2].min()))
+            b1 = int(np.ceil(target[:, 2].max())) + 1
+            ub, b0 = bak.slab(b0, b1)
+            if ub.shape[2] == 0:
+                continue
+            coords = target.T.copy()
+            coords[2] -= b0
+            sampled = np.stack(
+                [map_coordinates(ub[..., c], coords, order=1, mode="nearest") for c in range(3)],
+                axis=-1,
+            )
+            ice = np.linalg.norm(u[inside] + sampled, axis=-1)
+            n_ice += ice.size
+            ice_sum += float(ice.sum(dtype=np.float64))
+            ice_max = max(ice_max, float(ice.max()))
+            ice_hist += np.histogram(np.clip(ice, 0, ICE_BINS[-1]), ICE_BINS)[0]
+
+    report = {
+        "fwd": fwd_path,
+        "bak": bak_path,
+        "n_voxels": n_vox,
+        "jacobian": {
+            "min": jac_min if n_vox else None,
+            "max": jac_max if n_vox else None,
+            "mean": jac_sum / n_vox if n_vox else None,
+            "pct_folding": 100.0 * n_fold / n_vox if n_vox else None,
+            "percentiles": _percentiles(jac_hist, JACOBIAN_BINS[1:], n_vox),
+        },
+        "displacement": {
+            "mean": disp_sum / n_vox if n_vox else None,
+            "max": disp_max,
+            "bin_edges_mm": DISPLACEMENT_BINS.tolist(),
+            "histogram": disp_hist.tolist(),
+        },
+    }
+    if bak is not None:
+        report["ice"] = {
+            "mean": ice_sum / n_ice if n_ice else None,
+            "max": ice_max,
+            "p95": _percentiles(ice_hist, ICE_BINS[1:], n_ice)["95"],
+        }
+
+    flags = []
+    if n_vox:
+        if report["jacobian"]["pct_folding"] > thresholds["max_pct_folding"]:
+            flags.append("folding")
+        if jac_min < thresholds["min_jacobian"]:
+            flags.append("low_jacobian")
+        if disp_max > thresholds["max_displacement"]:
+            flags.append("large_displacement")
+        if bak is not None and report["ice"]["p95"] > thresholds["max_ice_p95"]:
+            flags.append("inverse_inconsistent")
+    else:
+        flags.append("empty_mask")
+    report["flags"] = flags
+    report["ok"] = not flags
+    return report
+
+
+def write_report(report, out_path):
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute Jacobian, inverse-consistency and displacement statistics of a warp."
+    )
+    parser.add_argument("--fwd", type=str, required=True,
+                        help="Path to the forward displacement field (NIfTI file).")
+    parser.add_argument("--bak", type=str, default=None,
+                        help="Path to the backward displacement field (NIfTI file).")
+    parser.add_argument("--mask", type=str, default=None,
+                        help="Optional mask on the field grid restricting the statistics.")
+    parser.add_argument("--frame", type=str, choices=["auto", "ras", "lps"], default="auto",
+                        help="Vector convention of the fields (auto: LPS for ANTs 5D fields).")
+    parser.add_argument("--slab", type=int, default=32,
+                        help="Number of z-slices processed at a time.")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output path for the JSON report.")
+    args = parser.parse_args()
+
+    report = analyse_warp(args.fwd, args.bak, args.mask, args.frame, args.slab)
+    write_report(report, args.out)
+    status = "OK" if report["ok"] else "FLAGGED (" + ", ".join(report["flags"]) + ")"
+    print(f"Warp quality {status}. Report saved as: {args.out}")
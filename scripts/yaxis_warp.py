@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def y_interpolation_table(warp_field, mode="constant", jacobian=False):
+    """
+    Precompute linear-interpolation indices and weights along y for a
+    displacement field that only acts on the y-axis.
+
+    Sampling position of voxel (x, y, z) is y + warp_field[x, y, z]. The
+    result is shared by every volume of a 4D image.
+
+    Parameters:
+    - warp_field: 3D numpy array (nx, ny, nz) of y displacements in voxels.
+    - mode: "constant" (samples outside [0, ny - 1] are 0, like
+      map_coordinates' default) or "nearest" (clamped to the edge).
+    - jacobian: bool, also compute the intensity modulation 1 + d(warp)/dy.
+
+    Returns:
+    - table: tuple (i0, i1, w0, w1, jac) with int32 indices, float32 weights
+      and the float32 Jacobian (or None).
+    """
+    warp_field = np.asarray(warp_field, dtype=np.float32)
+    ny = warp_field.shape[1]
+    y = np.arange(ny, dtype=np.float32)[None, :, None] + warp_field
+    if mode == "nearest":
+        valid = None
+    elif mode == "constant":
+        valid = (y >= 0) & (y <= ny - 1)
+    else:
+        raise ValueError(f"Unsupported mode '{mode}'")
+    y = np.clip(y, 0, ny - 1)
+    i0 = np.floor(y).astype(np.int32)
+    i1 = np.minimum(i0 + 1, ny - 1)
+    w1 = y - i0
+    w0 = 1 - w1
+    if valid is not None:
+        w0 *= valid
+        w1 *= valid
+    jac = None
+    if jacobian:
+        jac = (1 + np.gradient(warp_field, axis=1)).astype(np.float32)
+    return i0, i1, w0, w1, jac
+
+
+def apply_y_table(data, table, slab=8, out=None):
+    """
+    Apply a precomputed y-interpolation table to a 3D or 4D array with one
+    gather-and-lerp per z-slab, covering all volumes at once.
+
+    Parameters:
+    - data: numpy array (nx, ny, nz) or (nx, ny, nz, nvol).
+    - table: output of y_interpolation_table.
+    - slab: int, number of z-slices per step; bounds the temporaries.
+    - out: optional float32 array of the same shape to write into.
+
+    Returns:
+    - out: float32 array of the warped data.
+    """
+    i0, i1, w0, w1, jac = table
+    squeeze = data.ndim == 3
+    if squeeze:
+        data = data[..., None]
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    out_4d = out[..., None] if out.ndim == 3 else out
+
+    for z0 in range(0, data.shape[2], slab):
+        zs = slice(z0, min(z0 + slab, data.shape[2]))
+        block = np.asarray(data[:, :, zs], dtype=np.float32)
+        lo = np.take_along_axis(block, i0[:, :, zs, None], axis=1)
+        hi = np.take_along_axis(block, i1[:, :, zs, None], axis=1)
+        lo *= w0[:, :, zs, None]
+        hi *= w1[:, :, zs, None]
+        lo += hi
+        if jac is not None:
+            lo *= jac[:, :, zs, None]
+        out_4d[:, :, zs] = lo
+    return out[..., 0] if squeeze and out.ndim == 4 else out
+
+
+def apply_warpfield_y(data, warp_field, mode="constant", jacobian=False, slab=8):
+    """
+    Warp a 3D or 4D array along the y-axis with linear interpolation.
+
+    Parameters:
+    - data: numpy array (nx, ny, nz) or (nx, ny, nz, nvol).
+    - warp_field: 3D numpy array (nx, ny, nz) of y displacements in voxels.
+    - mode: "constant" or "nearest" boundary handling.
+    - jacobian: bool, modulate intensities by the Jacobian of the warp.
+    - slab: int, number of z-slices processed at a time.
+
+    Returns:
+    - warped: float32 array with the shape of data.
+    """
+    table = y_interpolation_table(warp_field, mode=mode, jacobian=jacobian)
+    return apply_y_table(data, table, slab=slab)
@@ -3,11 +3,16 @@ import numpy as np
 from dipy.align.imaffine import AffineRegistration, MutualInformationMetric, AffineMap
 from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
 from nibabel.processing import resample_from_to
+import os
 import subprocess
 import sys
 from dipy.io.image import load_nifti
 from dipy.io.gradients import read_bvals_bvecs
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from dwi_denoise import patch2self_slabs
+from brain_extraction import extract_brains
+
 def pad_to_multiple(data, divisor):
     """
     Pad the data symmetrically so that each dimension is a multiple of the given divisor.
@@ -33,13 +38,9 @@ print("DWI shape:", dwi_img.shape)
 print("B-values:", np.unique(bvals))
 
 
-from dipy.data import get_fnames
-from dipy.denoise.patch2self import patch2self
-
-denoised_dwi = patch2self(
+denoised_dwi = patch2self_slabs(
 dwi_img,
 bvals,
-model="ols",
 shift_intensity=True,
 clip_negative_vals=False,
 b0_threshold=50,
@@ -54,26 +55,12 @@ moving_img = nib.load("dwi_denoised.nii.gz")
 
 
 moving_img = nib.Nifti1Image(moving_img.get_fdata()[..., 0], moving_img.affine, moving_img.header)
-moving_img.to_filename("sub-HC131_ses-01_dir-PA_dwi_singlechannel.nii.gz")
-
-subprocess.run(['hd-bet -i sub-HC131_ses-01_dir-PA_dwi_singlechannel.nii.gz -o moving_BET.nii.gz --save_bet_mask'], shell=True)
-subprocess.run(['hd-bet -i mni_icbm152_t2_relx_tal_nlin_sym_09a.nii -o fixed_BET.nii.gz --save_bet_mask'], shell=True)
-
-fixed_mask = nib.load("fixed_BET_bet.nii.gz")
-fixed_img = nib.load("fixed_BET.nii.gz")
-moving_mask = nib.load("moving_BET_bet.nii.gz")
-moving_img = nib.load("moving_BET.nii.gz")
-
-
-
-
 
-fixed_data = fixed_img.get_fdata()
-fixed_data_mask = fixed_mask.get_fdata()
-fixed_data[fixed_data_mask == 0] = 0
-moving_data = moving_img.get_fdata()
-moving_data_mask = moving_mask.get_fdata()
-moving_data[moving_data_mask == 0] = 0
+# Brain-extract both images with a single in-process HD-BET model load
+(moving_data_mask, moving_data), (fixed_data_mask, fixed_data) = extract_brains([
+    (moving_img.get_fdata(), moving_img.affine),
+    (fixed_img.get_fdata(), fixed_img.affine),
+])
 
 # Robustly scale fixed_data using the 1st and 99th percentiles.
 p1_fixed, p99_fixed = np.percentile(fixed_data, (1, 99))